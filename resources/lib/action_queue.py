@@ -0,0 +1,131 @@
+import collections
+import itertools
+from typing import Callable, Final, Hashable, Optional
+
+from resources.lib.actions import Action
+
+
+# Queues actions first-in-first-out in two priorities, where patient actions
+# only run when nothing urgent is waiting and they're allowed to. Actions
+# are indexed by what they work on so that duplicates can be turned away
+# without searching the queues:
+#  - Actions limited to one at a time are keyed by their type, and hold
+#    back everything queued after them until they're able to start
+#  - Single item actions are keyed by their type and item, and are absorbed
+#    by a Sync All waiting at the same priority or higher that covers them
+#  - Anything else always gets queued
+# A duplicate that's turned away is merged into the action already queued.
+class ActionQueue:
+
+    _limited_types: Final = ('Sync All', 'Import All', 'Export All')
+
+    # After this many urgent actions have run ahead of a patient action that
+    # could have run, the patient action gets to go next
+    _max_patient_skips: Final = 20
+
+    def __init__(self):
+        self._urgent = collections.OrderedDict()
+        self._patient = collections.OrderedDict()
+        self._index = {}
+        self._unique_keys = itertools.count()
+        self._patient_skips = 0
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __bool__(self) -> bool:
+        return bool(self._index)
+
+    def is_limited(self, action: Action) -> bool:
+        return action.type in self._limited_types
+
+    # Whether an action of the type for the item is waiting to run at the
+    # given priority or higher
+    def is_queued(self, type_: str, item: tuple, patient: bool) -> bool:
+        queue = self._index.get((type_, item))
+        return queue is not None and (patient or queue is self._urgent)
+
+    # Returns whether there's anything new to run: the action was queued, or
+    # a duplicate of a patient action queued as urgent moved the existing
+    # one up
+    def push(self, action: Action, patient: bool) -> bool:
+        key = self._key(action)
+        queue = self._patient if patient else self._urgent
+
+        if key in self._index:
+            existing_queue = self._index[key]
+            existing = existing_queue[key]
+            existing.merge(action)
+            if existing_queue is self._patient and queue is self._urgent:
+                self._urgent[key] = self._patient.pop(key)
+                self._index[key] = self._urgent
+                if action.type == 'Sync All':
+                    self._absorb(existing, patient=False)
+                return True
+            return False
+
+        if action.item is not None:
+            if self.is_queued(action.type, action.item, patient):
+                return False
+            sync_all_queue = self._index.get('Sync All')
+            if (sync_all_queue is not None
+                    and (patient or sync_all_queue is self._urgent)
+                    and sync_all_queue['Sync All'].covers(action)):
+                return False
+
+        if action.type == 'Sync All':
+            self._absorb(action, patient)
+
+        queue[key] = action
+        self._index[key] = queue
+        return True
+
+    # Returns the first action that can start, with actions that can't yet
+    # keeping their place in the queue
+    def pop(self, can_run_patient: bool, can_start: Callable[[Action], bool] = lambda action: True) -> Optional[Action]:
+        if can_run_patient and self._patient_skips >= self._max_patient_skips:
+            action, is_held = self._pop_from(self._patient, can_start)
+            if action is not None:
+                return action
+
+        action, is_held = self._pop_from(self._urgent, can_start)
+        if action is not None:
+            if self._patient and can_run_patient:
+                self._patient_skips += 1
+            return action
+
+        if is_held or not can_run_patient:
+            return None
+
+        action, _ = self._pop_from(self._patient, can_start)
+        return action
+
+    # Also returns whether the rest of the queue is being held back
+    def _pop_from(self, queue: collections.OrderedDict, can_start: Callable[[Action], bool]) -> tuple:
+        for key, action in queue.items():
+            if can_start(action):
+                del queue[key]
+                del self._index[key]
+                if queue is self._patient:
+                    self._patient_skips = 0
+                return action, False
+            if action.type in self._limited_types:
+                return None, True
+        return None, False
+
+    # Single item actions the Sync All covers that would run no sooner than
+    # it are dropped
+    def _absorb(self, sync_all: Action, patient: bool) -> None:
+        queues = [self._patient] if patient else [self._patient, self._urgent]
+        for queue in queues:
+            absorbed = [key for key, action in queue.items() if action.item is not None and sync_all.covers(action)]
+            for key in absorbed:
+                del queue[key]
+                del self._index[key]
+
+    def _key(self, action: Action) -> Hashable:
+        if action.type in self._limited_types:
+            return action.type
+        if action.item is not None:
+            return action.type, action.item
+        return next(self._unique_keys)
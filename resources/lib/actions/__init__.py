@@ -1,4 +1,4 @@
-from .action import Action, ActionError, _PhasedAction, _RequestResponseAction
+from .action import Action, ActionError, Gather, Notification, Timer, _CoroutineAction, _PhasedAction
 from .import_ import ImportOne, ImportAll
 from .export import ExportOne, ExportAll
 from .sync import SyncOne, SyncAll
@@ -1,4 +1,9 @@
-from typing import Final, Iterator, Optional
+import itertools
+import types
+from typing import Callable, Final, Generator, Iterable, Iterator, Optional
+
+import resources.lib.jsonrpc as jsonrpc
+from resources.lib.alarm import Alarm
 
 
 class Action:
@@ -18,13 +23,43 @@ class Action:
             return True
         return False
 
+    # Actions waiting on more than one kind of notification override this
+    # to accept all of them
+    def is_awaiting(self, method: str) -> bool:
+        return self._awaiting is not None and method == self._awaiting
+
     @property
     def type(self) -> str:
         return self._type
 
+    # The (type, id) of the library item an action works on, for actions
+    # that work on a single item
+    @property
+    def item(self) -> Optional[tuple]:
+        return None
+
     def run(self, data: Optional[dict] = None) -> bool:
         return True
 
+    # Continues an action with a notification it's awaiting. Returns whether
+    # the notification was consumed.
+    def receive(self, method: str, data: Optional[dict]) -> bool:
+        del method
+        return self.run(data)
+
+    # Gives up on an action that hasn't finished
+    def cancel(self) -> None:
+        self._awaiting = None
+
+    # Takes on anything more that a duplicate of this action was asked to
+    # do, when the duplicate is turned away in favour of this one
+    def merge(self, other: 'Action') -> None:
+        pass
+
+    # Whether running this does everything running the other action would
+    def covers(self, other: 'Action') -> bool:
+        return False
+
 
 class ActionError(Exception):
 
@@ -33,64 +68,383 @@ class ActionError(Exception):
         self.notification: Final = notification
 
 
-class _RequestResponseAction(Action):
+# Things a coroutine can wait on by yielding them. The engine starts each
+# one, and if it doesn't finish straight away, passes it the notifications
+# it's awaiting until it does. Whatever it finishes with is sent back into
+# the coroutine, and any exception it raises is thrown into it.
+class _Awaitable:
 
-    _type = '[Request-Response Action]'
+    def __init__(self):
+        self.is_done = False
+        self.result = None
 
-    def run(self, data: Optional[dict] = None) -> bool:
-        del data
-        if self._awaiting:
-            self._awaiting = None
+    @property
+    def awaiting(self) -> Optional[str]:
+        return None
+
+    def is_awaiting(self, method: str) -> bool:
+        return False
+
+    def start(self) -> None:
+        pass
+
+    def receive(self, method: str, data: Optional[dict]) -> bool:
+        return False
+
+    def cancel(self) -> None:
+        self.is_done = True
+
+    def _finish(self, result=None) -> None:
+        self.is_done = True
+        self.result = result
+
+
+# Finishes with the data of the first notification of the method that
+# matches. Some notifications still need to be seen by the service after,
+# so they can be left unconsumed.
+class Notification(_Awaitable):
+
+    def __init__(self, method: str, match: Optional[Callable[[dict], bool]] = None, consume: bool = True):
+        super().__init__()
+        self._method = method
+        self._match = match
+        self._consume = consume
+
+    @property
+    def awaiting(self) -> Optional[str]:
+        return None if self.is_done else self._method
+
+    def is_awaiting(self, method: str) -> bool:
+        return not self.is_done and method == self._method
+
+    def receive(self, method: str, data: Optional[dict]) -> bool:
+        if not self.is_awaiting(method):
+            return False
+        if self._match is not None and not self._match(data or {}):
+            return False
+        self._finish(data)
+        return self._consume
+
+
+class Timer(_Awaitable):
+
+    _names: Final = itertools.count()
+
+    def __init__(self, seconds: int):
+        super().__init__()
+        self._seconds = seconds
+        self._name = f'Timer.{next(self._names)}'
+        self._alarm = Alarm(
+            name=self._name,
+            message=jsonrpc.INTERNAL_METHODS.timer.send,
+            data={'timer': self._name}
+        )
+
+    @property
+    def awaiting(self) -> Optional[str]:
+        return None if self.is_done else jsonrpc.INTERNAL_METHODS.timer.recv
+
+    def is_awaiting(self, method: str) -> bool:
+        return not self.is_done and method == jsonrpc.INTERNAL_METHODS.timer.recv
+
+    # Starting a timer again, finished or not, counts down from the top
+    def start(self) -> None:
+        self.is_done = False
+        self._alarm.set_seconds(self._seconds)
+
+    def receive(self, method: str, data: Optional[dict]) -> bool:
+        if not self.is_awaiting(method) or (data or {}).get('timer') != self._name:
+            return False
+        self._finish()
+        return True
+
+    def cancel(self) -> None:
+        if not self.is_done:
+            self._alarm.cancel()
+        super().cancel()
+
+
+# Runs an action to completion, finishing with whether it consumed the
+# last notification it was given
+class _Run(_Awaitable):
+
+    def __init__(self, action: Action):
+        super().__init__()
+        self._action = action
+
+    @property
+    def awaiting(self) -> Optional[str]:
+        return None if self.is_done else self._action.awaiting
+
+    def is_awaiting(self, method: str) -> bool:
+        return not self.is_done and self._action.is_awaiting(method)
+
+    def start(self) -> None:
+        self._action.run()
+        if self._action.is_done:
+            self._finish(True)
+
+    def receive(self, method: str, data: Optional[dict]) -> bool:
+        is_notification_consumed = self._action.receive(method, data)
+        if self._action.is_done:
+            self._finish(is_notification_consumed)
+        return is_notification_consumed
+
+    def cancel(self) -> None:
+        if not self.is_done:
+            self._action.cancel()
+        super().cancel()
+
+
+# Steps a coroutine along, one awaitable at a time, finishing with what the
+# coroutine returns
+class _Task(_Awaitable):
+
+    def __init__(self, coroutine: Generator):
+        super().__init__()
+        self._coroutine = coroutine
+        self._current = None
+
+    @property
+    def awaiting(self) -> Optional[str]:
+        return None if self.is_done else self._current.awaiting
+
+    def is_awaiting(self, method: str) -> bool:
+        return not self.is_done and self._current.is_awaiting(method)
+
+    def start(self) -> None:
+        self._step(self._coroutine.send, None)
+
+    def receive(self, method: str, data: Optional[dict]) -> bool:
+        try:
+            is_notification_consumed = self._current.receive(method, data)
+        except Exception as error:
+            self._step(self._coroutine.throw, error)
             return True
-        self._request()
 
-    def _request(self):
-        return
+        if self._current.is_done:
+            self._step(self._coroutine.send, self._current.result)
+        return is_notification_consumed
 
+    def cancel(self) -> None:
+        if self.is_done:
+            return
+        if self._current is not None:
+            self._current.cancel()
+        self._coroutine.close()
+        super().cancel()
 
-class _PhasedAction(Action):
+    def _step(self, resume: Callable, value) -> None:
+        while True:
+            try:
+                awaitable = _as_awaitable(resume(value))
+            except StopIteration as stop:
+                self._current = None
+                self._finish(stop.value)
+                return
 
-    _type = '[Phased Action]'
+            self._current = awaitable
+            try:
+                awaitable.start()
+            except Exception as error:
+                resume, value = self._coroutine.throw, error
+                continue
+
+            if not awaitable.is_done:
+                return
+            resume, value = self._coroutine.send, awaitable.result
+
+
+# Runs several awaitables side by side, with at most the limit of them
+# going at once, and finishes with their results in order. They can come
+# from a generator, which is only drawn from as there's room, so there's no
+# need to have everything lined up before starting. If an idle timeout is
+# given and nothing finishes within it, whatever is still going is given up
+# on and has None as its result. An exception from any of them gives up on
+# the rest and is passed on.
+class Gather(_Awaitable):
+
+    def __init__(self, awaitables: Iterable, limit: Optional[int] = None, idle_timeout: Optional[int] = None):
+        super().__init__()
+        self._awaitables = iter(awaitables)
+        self._limit = limit
+        self._timer = Timer(idle_timeout) if idle_timeout is not None else None
+        self._running = {}
+        self._results = []
+        self._is_exhausted = False
+
+    @property
+    def awaiting(self) -> Optional[str]:
+        if self.is_done:
+            return None
+        for awaitable in self._running.values():
+            return awaitable.awaiting
+        return None
+
+    def is_awaiting(self, method: str) -> bool:
+        if self.is_done:
+            return False
+        if self._timer is not None and self._timer.is_awaiting(method):
+            return True
+        return any(awaitable.is_awaiting(method) for awaitable in self._running.values())
+
+    def start(self) -> None:
+        self._fill()
+
+    def receive(self, method: str, data: Optional[dict]) -> bool:
+        if self._timer is not None and self._timer.is_awaiting(method):
+            if self._timer.receive(method, data):
+                self._give_up()
+                return True
+
+        is_notification_consumed = False
+        is_any_finished = False
+        for index, awaitable in list(self._running.items()):
+            if not awaitable.is_awaiting(method):
+                continue
+            try:
+                is_notification_consumed = awaitable.receive(method, data)
+            except Exception:
+                self.cancel()
+                raise
+            if awaitable.is_done:
+                self._results[index] = awaitable.result
+                del self._running[index]
+                is_any_finished = True
+            if is_notification_consumed:
+                break
+
+        if is_any_finished:
+            self._fill()
+        return is_notification_consumed
+
+    def cancel(self) -> None:
+        for awaitable in self._running.values():
+            awaitable.cancel()
+        self._running.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+        super().cancel()
+
+    def _fill(self) -> None:
+        while not self._is_exhausted and (self._limit is None or len(self._running) < self._limit):
+            awaitable = next(self._awaitables, None)
+            if awaitable is None:
+                self._is_exhausted = True
+                break
+
+            awaitable = _as_awaitable(awaitable)
+            index = len(self._results)
+            self._results.append(None)
+            try:
+                awaitable.start()
+            except Exception:
+                self.cancel()
+                raise
+
+            if awaitable.is_done:
+                self._results[index] = awaitable.result
+            else:
+                self._running[index] = awaitable
+
+        if not self._running:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._finish(self._results)
+            return
+
+        if self._timer is not None:
+            self._timer.start()
+
+    def _give_up(self) -> None:
+        for awaitable in self._running.values():
+            awaitable.cancel()
+        self._running.clear()
+        self._fill()
+
+
+def _as_awaitable(value) -> _Awaitable:
+    if isinstance(value, _Awaitable):
+        return value
+    if isinstance(value, Action):
+        return _Run(value)
+    if isinstance(value, types.GeneratorType):
+        return _Task(value)
+    raise TypeError(f'Unable to await {value!r}')
+
+
+# Actions written as a coroutine that yields whatever it needs to wait on.
+# Yielding an action runs it, and yielding another coroutine runs that
+# within this one; yield from works as well.
+class _CoroutineAction(Action):
+
+    _type = '[Coroutine Action]'
 
     def __init__(self):
         super().__init__()
-        self._active_phase = None
-        self._future_phases = self._phases()
+        self._task = None
+
+    @property
+    def is_done(self) -> bool:
+        return self._task is None or self._task.is_done
+
+    def is_awaiting(self, method: str) -> bool:
+        return self._task is not None and self._task.is_awaiting(method)
 
     def run(self, data: Optional[dict] = None) -> bool:
+        if self._task is not None:
+            if self._awaiting is None:
+                return False
+            return self.receive(self._awaiting, data)
+
+        self._task = _Task(self._coroutine())
+        return self._continue(self._task.start)
+
+    def receive(self, method: str, data: Optional[dict]) -> bool:
+        return self._continue(lambda: self._task.receive(method, data))
+
+    def cancel(self) -> None:
+        if self.is_done:
+            return
+        self._task.cancel()
+        self._awaiting = None
+        self._cleanup()
+
+    def _continue(self, step: Callable[[], Optional[bool]]) -> bool:
         try:
-            return self._run_phases(data)
+            is_notification_consumed = step()
         except Exception as error:
+            self._task.cancel()
             self._awaiting = None
             self._cleanup()
             raise error
 
-    def _run_phases(self, data: Optional[dict] = None) -> bool:
-        while True:
-            if not self._active_phase:
-                try:
-                    self._active_phase = next(self._future_phases)
-                except StopIteration:
-                    self._cleanup()
-                    return True
+        self._awaiting = self._task.awaiting
+        if self._task.is_done:
+            self._cleanup()
+        return True if is_notification_consumed is None else is_notification_consumed
+
+    def _coroutine(self) -> Generator:
+        return
+        yield
+
+    def _cleanup(self) -> None:
+        pass
+
+
+class _PhasedAction(_CoroutineAction):
 
+    _type = '[Phased Action]'
+
+    def _coroutine(self) -> Generator:
+        for phase in self._phases():
             try:
-                self._active_phase.run(data)
+                yield _Run(phase)
             except ActionError as error:
                 self._exception(error)
 
-            if not self._active_phase.is_done:
-                self._awaiting = self._active_phase.awaiting
-                return True
-            self._active_phase = None
-            self._awaiting = None
-            data = None
-
     def _phases(self) -> Iterator[Action]:
         return iter(())
 
-    def _cleanup(self) -> None:
-        pass
-
     def _exception(self, error: Exception) -> None:
         raise error
@@ -1,19 +1,36 @@
+import collections
+import concurrent.futures
 import datetime
+import re
 import xml.etree.ElementTree as ElementTree
+import xml.sax.saxutils as saxutils
 from typing import Callable, Final, Iterator, Optional, Union
 
 import xbmcvfs
 
 import resources.lib.gui as gui
 import resources.lib.media as media
+import resources.lib.nfo_document as nfo_document
 import resources.lib.settings as settings
 from resources.lib.addon import addon
 from resources.lib.last_known import last_known
+from resources.lib.nfo_index import nfo_index
 
 from . import *
 from . import _PhasedAction
 
 
+# What an export did, for ExportOne.record to bring the last known state in
+# line with it
+_ExportResult = collections.namedtuple(
+    'ExportResult',
+    ['is_written', 'checksum', 'section_checksums', 'nfo_checksum']
+)
+
+_xml_encoding: Final = re.compile(r'\s*<\?xml[^>]*\bencoding=["\']([^"\']*)["\']')
+_xml_comment: Final = re.compile(r'<!--.*?-->', re.DOTALL)
+
+
 class ExportOne(Action):
 
     _type: Final = 'Export One'
@@ -42,11 +59,13 @@ class ExportOne(Action):
     def __init__(
             self,
             info: media.MediaInfo,
-            overwrite: Optional[bool] = None
+            overwrite: Optional[bool] = None,
+            only_changed: bool = False
     ):
         super().__init__()
 
         self._info = info
+        self._only_changed = only_changed
 
         self._can_overwrite = overwrite
         if self._can_overwrite is None:
@@ -56,18 +75,46 @@ class ExportOne(Action):
         if overwrite is not None:
             self._can_overwrite_watch_info = overwrite
 
-        self._tree = None
-        self._read_nfo()
-        if self._tree is None and settings.export.can_create_nfo:
-            self._tree = ElementTree.Element(self._root_tags[self._info.type])
+        self._document = None
+        self._original_xml = None
+        self._nfo_contents = self._read_nfo()
+
+        # Minimal exports try patching the NFO text first, so parsing waits
+        # until it's known to be needed
+        if self._nfo_contents is not None and not settings.export.is_minimal:
+            self._parse_nfo()
+        elif self._nfo_contents is None and settings.export.can_create_nfo:
+            self._document = nfo_document.NfoDocument(ElementTree.Element(self._root_tags[self._info.type]))
 
-        self._cleared_arts = []
+        self._cleared_arts = set()
         self._fanart_tag = None
 
+    @property
+    def item(self) -> Optional[tuple]:
+        return self._info.type, self._info.id
+
+    @property
+    def only_changed(self) -> bool:
+        return self._only_changed
+
+    def merge(self, other: Action) -> None:
+        if isinstance(other, ExportOne) and not other.only_changed:
+            self._only_changed = False
+
     def run(self, data: Optional[dict] = None) -> bool:
         del data
-        if self._tree is None:
-            return True
+        result = self.export()
+        if result is not None:
+            self.record(result)
+        return True
+
+    # Builds and writes the NFO. Other than the info being exported, nothing
+    # shared is touched, so this can run on a worker thread so long as the
+    # info's NFO has already been looked up and only changed sections
+    # weren't asked for.
+    def export(self) -> Optional[_ExportResult]:
+        if self._document is None and self._nfo_contents is None:
+            return None
 
         handlers = {
             'art': self._convert_art,
@@ -81,43 +128,88 @@ class ExportOne(Action):
             'uniqueid': self._convert_uniqueid,
             'trailer': self._convert_trailer
         }
+        # The checksums have to be taken before converting, since some of
+        # the handlers rework the details in place
+        checksum = self._info.checksum
+        section_checksums = self._info.section_checksums
+
+        # A new NFO needs everything, but an existing one only needs the
+        # sections that changed since it was last exported
+        sections = None
+        if self._only_changed and self._info.nfo is not None:
+            sections = last_known.changed_sections(self._info)
+
+        if settings.export.is_minimal and self._nfo_contents is not None:
+            contents = self._patch_nfo(sections)
+            if contents is not None:
+                return _ExportResult(self._write_contents(contents), checksum, section_checksums, None)
+            self._parse_nfo()
+
         addon.log(f'Export - Source Info (Details):\n{self._info.details}', verbose=True)
         if settings.export.is_minimal:
             for field in self._minimal_fields:
                 if field not in self._info.details:
                     continue
+                if sections is not None and media.section_of(field) not in sections:
+                    continue
                 handler: Callable[..., None] = handlers.get(field, self._convert_generic)
                 handler(field, self._info.details[field])
         else:
             for field, value in self._info.details.items():
                 if field in self._ignored_fields:
                     continue
+                if sections is not None and media.section_of(field) not in sections:
+                    continue
                 handler: Callable[..., None] = handlers.get(field, self._convert_generic)
                 handler(field, value)
 
-            addon.log(f'Export - Source Info (Art):\n{self._info.art}', verbose=True)
-            for art in self._info.art:
-                self._convert_art(art)
+            if sections is None or 'art' in sections:
+                addon.log(f'Export - Source Info (Art):\n{self._info.art}', verbose=True)
+                for art in self._info.art:
+                    self._convert_art(art)
 
-            if self._info.type == 'tvshow':
+            if self._info.type == 'tvshow' and (sections is None or 'seasons' in sections):
                 for season in self._info.seasons.values():
                     self._convert_season(season)
 
-        self._write_nfo()
-
-        timestamp = self._info.nfo_modification_time()
-        if timestamp is None:
-            addon.log(
-                f'Unable to update timestamp for {self._info.type} with ID {self._info.id}'
-                f'- could not get modified timestamp for file "{self._info.nfo}"'
-            )
+        # The NFO checksum vouches for the NFO matching the library, apart
+        # from the watch state, so it's only kept when the NFO was entirely
+        # overwritten from the library. Exporting only the changed sections
+        # counts when the rest was already vouched for.
+        nfo_checksum = None
+        is_overwritten = (
+            self._can_overwrite
+            and not settings.export.is_minimal
+            and (sections is None or last_known.nfo_checksum(self._info.type, self._info.id) is not None)
+        )
+        if settings.import_.should_set_watch_state and is_overwritten:
+            nfo_checksum = nfo_document.content_checksum(self._document.root, nfo_document.WATCH_STATE_TAGS)
+
+        return _ExportResult(self._write_nfo(), checksum, section_checksums, nfo_checksum)
+
+    # An NFO that wasn't written keeps its old timestamp, but the checksum
+    # still moves on since the NFO already matches the library. Has to run
+    # on the main thread.
+    def record(self, result: _ExportResult) -> None:
+        if result.is_written:
+            nfo_index.invalidate(self._info.nfo)
+            timestamp = self._info.nfo_modification_time()
+            if timestamp is None:
+                addon.log(
+                    f'Unable to update timestamp for {self._info.type} with ID {self._info.id}'
+                    f'- could not get modified timestamp for file "{self._info.nfo}"'
+                )
+            else:
+                last_known.set_timestamp(self._info.type, self._info.id, timestamp, nfo=self._info.nfo)
+        last_known.set_checksum(self._info.type, self._info.id, result.checksum, result.section_checksums)
+        if result.nfo_checksum is not None:
+            last_known.set_nfo_checksum(self._info.type, self._info.id, result.nfo_checksum)
         else:
-            last_known.set_timestamp(self._info.type, self._info.id, timestamp)
-        last_known.set_checksum(self._info.type, self._info.id, self._info.checksum)
+            last_known.clear_nfo_checksum(self._info.type, self._info.id)
 
-    def _read_nfo(self) -> None:
+    def _read_nfo(self) -> Optional[str]:
         if self._info.nfo is None:
-            return
+            return None
 
         with xbmcvfs.File(self._info.nfo) as file:
             nfo_contents = file.read()
@@ -125,28 +217,119 @@ class ExportOne(Action):
         if nfo_contents == '':
             raise ActionError(32043, f'Unable to read NFO or file empty - "{self._info.nfo}"')
 
+        return nfo_contents
+
+    def _parse_nfo(self) -> None:
         try:
-            self._tree = ElementTree.fromstring(nfo_contents)
+            root = ElementTree.fromstring(self._nfo_contents)
         except ElementTree.ParseError as error:
             raise ActionError(32043, f'Unable to parse NFO file "{self._info.nfo}" due to error: {error}')
 
-    def _write_nfo(self):
+        # Parsing drops comments, so the original serialized the same way as
+        # the new document is everything but the "Created by" comment
+        if settings.export.should_skip_unchanged:
+            self._pretty_print(root)
+            self._original_xml = ElementTree.tostring(root, encoding='UTF-8')
+
+        self._document = nfo_document.NfoDocument(root)
+
+    # Returns whether the NFO was written, which it isn't if nothing but the
+    # "Created by" comment would have changed
+    def _write_nfo(self) -> bool:
+        root = self._document.root
+        if self._original_xml is not None:
+            self._pretty_print(root)
+            if ElementTree.tostring(root, encoding='UTF-8') == self._original_xml:
+                addon.log(f'Export - Skipped unchanged NFO "{self._info.nfo}"', verbose=True)
+                return False
+
         comment = ElementTree.Comment(
             f'Created {datetime.datetime.now().isoformat(" ", "seconds")} by {addon.name} {addon.version}'
         )
-        self._tree.insert(0, comment)
+        root.insert(0, comment)
 
-        self._pretty_print(self._tree)
+        self._pretty_print(root)
 
         if self._info.nfo is None:
             self._info.create_nfo_path()
 
-        xml = ElementTree.tostring(self._tree, encoding='UTF-8', xml_declaration=True)
+        xml = ElementTree.tostring(root, encoding='UTF-8', xml_declaration=True)
+        self._write_bytes(xml)
+        return True
+
+    def _write_contents(self, contents: str) -> bool:
+        if contents == self._nfo_contents and settings.export.should_skip_unchanged:
+            addon.log(f'Export - Skipped unchanged NFO "{self._info.nfo}"', verbose=True)
+            return False
+
+        self._write_bytes(contents.encode('utf-8'))
+        return True
+
+    def _write_bytes(self, xml: bytes) -> None:
         with xbmcvfs.File(self._info.nfo, 'w') as file:
             success = file.write(xml)
         if not success:
             raise ActionError(32043, f'Unable to write NFO file "{self._info.nfo}"')
 
+    # Sets the watch state tags by editing the NFO text directly, leaving
+    # everything else in the file exactly as it was. Returns None if the text
+    # isn't simple enough to be sure of the edit, such as a tag appearing
+    # more than once, in a comment, with attributes, or alongside CDATA.
+    def _patch_nfo(self, sections: Optional[set]) -> Optional[str]:
+        contents = self._nfo_contents
+
+        values = {}
+        if sections is None or 'watched' in sections:
+            if 'playcount' in self._info.details:
+                playcount = self._info.details['playcount']
+                values['playcount'] = str(playcount)
+                values['watched'] = 'true' if playcount > 0 else 'false'
+            if 'lastplayed' in self._info.details:
+                values['lastplayed'] = self._info.details['lastplayed']
+
+        if '<![CDATA[' in contents:
+            return None
+        encoding = _xml_encoding.match(contents)
+        if encoding and encoding.group(1).lower() != 'utf-8':
+            return None
+
+        root = self._root_tags[self._info.type]
+        closings = list(re.finditer(f'</{root}\\s*>', contents))
+        if len(closings) != 1 or contents[closings[0].end():].strip():
+            return None
+
+        for tag, value in values.items():
+            starts = [match.start() for match in re.finditer(f'<{tag}[\\s/>]', contents)]
+            if len(starts) > 1:
+                return None
+            comments = [match.span() for match in _xml_comment.finditer(contents)]
+            if any(start < tag_start < end for start, end in comments for tag_start in starts):
+                return None
+
+            # Written the way ElementTree would, so a full export of the same
+            # values gives the same text
+            text = saxutils.escape(value)
+            new_element = f'<{tag}>{text}</{tag}>' if text else f'<{tag} />'
+            if not starts:
+                contents = self._insert_tag(contents, root, new_element)
+                continue
+
+            element = re.compile(f'<{tag}>[^<]*</{tag}>|<{tag}\\s*/>').match(contents, starts[0])
+            if element is None:
+                return None
+            if self._can_overwrite_watch_info:
+                contents = f'{contents[:element.start()]}{new_element}{contents[element.end():]}'
+
+        return contents
+
+    def _insert_tag(self, contents: str, root: str, element: str) -> str:
+        newline = '\r\n' if '\r\n' in contents else '\n'
+        closing = re.search(f'</{root}\\s*>', contents).start()
+        line_start = contents.rfind('\n', 0, closing) + 1
+        if contents[line_start:closing].strip() == '':
+            return f'{contents[:line_start]}    {element}{newline}{contents[line_start:]}'
+        return f'{contents[:closing]}{element}{contents[closing:]}'
+
     def _pretty_print(self, element: ElementTree.Element, level=1) -> None:
         def indent(indent_level):
             return '\n' + '    ' * indent_level
@@ -174,9 +357,9 @@ class ExportOne(Action):
 
         if isinstance(value, list):
             for item in value:
-                self._add_tag(self._tree, tag, str(item))
+                self._document.add(tag, str(item))
         else:
-            self._add_tag(self._tree, tag, str(value))
+            self._document.add(tag, str(value))
 
     def _convert_art(self, art: dict, season: Optional[int] = None) -> None:
         type_ = art['arttype']
@@ -221,7 +404,7 @@ class ExportOne(Action):
         if self._fanart_tag is None:
             if not self._try_clear_tags('fanart'):
                 return
-            self._fanart_tag = self._add_tag(self._tree, 'fanart')
+            self._fanart_tag = self._document.add('fanart')
 
         thumb = self._add_tag(self._fanart_tag, 'thumb', path)
         if preview:
@@ -233,70 +416,61 @@ class ExportOne(Action):
         # Also, we want to do this seasonally for TV shows
         art_code = type_ if season is None else f'{type_}.season{season}'
         if art_code not in self._cleared_arts:
-            if not self._try_clear_art(type_, season):
+            if not self._try_clear(self._document.thumbs(type_, season)):
                 return
-            self._cleared_arts.append(art_code)
+            self._cleared_arts.add(art_code)
 
-        element = self._add_tag(self._tree, 'thumb')
-        element.text = path
-        element.set('aspect', str(type_))
+        # The thumb is indexed by its attributes, so they're set up front
+        attributes = {'aspect': str(type_)}
         if preview:
-            element.set('preview', str(preview))
+            attributes['preview'] = str(preview)
         if season is not None:
-            element.set('season', str(season))
-            element.set('type', 'season')
-
-    def _try_clear_art(self, type_: str, season: Optional[int]) -> bool:
-        if season is None:
-            for elem in self._tree.findall(f'thumb[@aspect=\'{type_}\']'):
-                # ElementTree doesn't let us filter by an attribute not existing,
-                # so we just skip over season images in non-season image clears
-                if elem.get('season'):
-                    continue
-                elif not self._can_overwrite:
-                    return False
-                self._tree.remove(elem)
-        else:
-            if not self._try_clear_tags(f'thumb[@aspect=\'{type_}\'][@season=\'{season}\']'):
-                return False
-        return True
+            attributes['season'] = str(season)
+            attributes['type'] = 'season'
+        self._document.add('thumb', path, attributes)
 
     def _convert_cast(self, field: str, actors: list) -> None:
         del field
 
-        existing_actors = self._tree.findall('actor')
+        existing_actors = self._document.find_all('actor')
         if existing_actors and (settings.export.actor_handling == settings.ActorOption.LEAVE
                                 or not self._can_overwrite):
             return
 
-        actor_bin = ElementTree.Element('bucket')
-
+        # Existing actors are looked up by name before they're cleared out,
+        # so they can be put back in the new order
+        old_actors = {}
         if settings.export.actor_handling != settings.ActorOption.OVERWRITE:
-            actor_bin.extend(existing_actors)
+            for actor in actors:
+                element = self._document.actor(actor['name'])
+                if element is not None:
+                    old_actors.setdefault(actor['name'], element)
 
-        for actor in existing_actors:
-            self._tree.remove(actor)
+        self._document.remove(existing_actors)
 
         if settings.export.actor_handling == settings.ActorOption.UPDATE:
-            self._update_cast(actors, actor_bin)
+            self._update_cast(actors, existing_actors)
         else:
-            self._merge_cast(actors, actor_bin)
+            self._merge_cast(actors, old_actors)
+
+    def _update_cast(self, new_actors: list, old_actors: list):
+        details_by_name = {}
+        for actor in new_actors:
+            details_by_name.setdefault(actor['name'], actor)
 
-    def _update_cast(self, new_actors: list, old_actors: ElementTree.Element):
         for element in old_actors:
-            self._tree.append(element)
-            actor_name = element.find('name').text
-            details = next((a for a in new_actors if a['name'] == actor_name), None)
+            self._document.append(element)
+            details = details_by_name.get(element.findtext('name'))
             if details is not None:
                 self._update_actor(element, details)
 
-    def _merge_cast(self, new_actors: list, old_actors: ElementTree.Element):
+    def _merge_cast(self, new_actors: list, old_actors: dict):
         for actor in new_actors:
-            element = old_actors.find(f'*/[name=\'{actor["name"]}\']')
+            element = old_actors.get(actor['name'])
             if element is None:
-                element = self._add_tag(self._tree, 'actor')
+                element = self._document.add('actor')
             else:
-                self._tree.append(element)
+                self._document.append(element)
             self._update_actor(element, actor)
 
     def _update_actor(self, element: ElementTree.Element, details: dict) -> None:
@@ -312,21 +486,21 @@ class ExportOne(Action):
     def _convert_lastplayed(self, field: str, date: str) -> None:
         del field
 
-        existing_lastplayed = self._tree.find('lastplayed')
+        existing_lastplayed = self._document.find('lastplayed')
         if existing_lastplayed is None or self._can_overwrite_watch_info:
-            self._set_tag(self._tree, 'lastplayed', date)
+            self._document.set('lastplayed', date)
 
     def _convert_playcount(self, field: str, count: int) -> None:
         del field
 
-        existing_playcount = self._tree.find('playcount')
+        existing_playcount = self._document.find('playcount')
         if existing_playcount is None or self._can_overwrite_watch_info:
-            self._set_tag(self._tree, 'playcount', str(count))
+            self._document.set('playcount', str(count))
 
         watched = 'true' if count > 0 else 'false'
-        existing_watched = self._tree.find('watched')
+        existing_watched = self._document.find('watched')
         if existing_watched is None or self._can_overwrite_watch_info:
-            self._set_tag(self._tree, 'watched', watched)
+            self._document.set('watched', watched)
 
     def _convert_ratings(self, field: str, ratings: dict) -> None:
         del field
@@ -334,7 +508,7 @@ class ExportOne(Action):
         if not self._try_clear_tags('ratings'):
             return
 
-        element = self._add_tag(self._tree, 'ratings')
+        element = self._document.add('ratings')
 
         for rater, details in ratings.items():
             rating = self._add_tag(element, 'rating')
@@ -358,7 +532,7 @@ class ExportOne(Action):
 
         runtime_in_minutes = (runtime + 30) // 60
 
-        self._add_tag(self._tree, 'runtime', str(runtime_in_minutes))
+        self._document.add('runtime', str(runtime_in_minutes))
 
     def _convert_set(self, field: str, set_id: int) -> None:
         del field
@@ -369,7 +543,7 @@ class ExportOne(Action):
         if not self._try_clear_tags('set'):
             return
 
-        element = self._add_tag(self._tree, 'set')
+        element = self._document.add('set')
         self._add_tag(element, 'title', str(self._info.movieset['title']))
         self._add_tag(element, 'overview', str(self._info.movieset['plot']))
 
@@ -379,7 +553,7 @@ class ExportOne(Action):
         if not self._try_clear_tags('fileinfo'):
             return
 
-        file_info = self._add_tag(self._tree, 'fileinfo')
+        file_info = self._document.add('fileinfo')
         stream_details = self._add_tag(file_info, 'streamdetails')
 
         for video_info in details['video']:
@@ -409,30 +583,30 @@ class ExportOne(Action):
         if not self._try_clear_tags('trailer'):
             return
 
-        self._add_tag(self._tree, 'trailer', str(path))
+        self._document.add('trailer', str(path))
 
     def _convert_uniqueid(self, field: str, unique_ids: dict) -> None:
         del field
 
         default = None
-        default_tag = self._tree.find(f'uniqueid[@default=\'true\']')
-        if default_tag:
-            default = default_tag.get('type', None)
+        default_tags = self._document.find_all('uniqueid', default='true')
+        if default_tags:
+            default = default_tags[0].get('type', None)
 
         if not self._try_clear_tags('uniqueid'):
             return
 
         for service, service_id in unique_ids.items():
-            element = self._add_tag(self._tree, 'uniqueid', str(service_id))
-            element.set('type', str(service))
+            attributes = {'type': str(service)}
             if service == default:
-                element.set('default', 'true')
+                attributes['default'] = 'true'
+            self._document.add('uniqueid', str(service_id), attributes)
 
     def _convert_season(self, season: media.SeasonInfo) -> None:
         addon.log(f'Export - Source JSON (Season {season.details["season"]} Details):\n{season.details}', verbose=True)
-        if 'title' in season.details and self._try_clear_tags(f'namedseason[@number=\'{season.details["season"]}\']'):
-            named_season = self._add_tag(self._tree, 'namedseason', str(season.details['title']))
-            named_season.set('number', str(season.details['season']))
+        number = str(season.details['season'])
+        if 'title' in season.details and self._try_clear(self._document.find_all('namedseason', number=number)):
+            self._document.add('namedseason', str(season.details['title']), {'number': number})
 
         addon.log(f'Export - Source JSON (Season {season.details["season"]} Art):\n{season.art}', verbose=True)
         for art in season.art:
@@ -450,12 +624,13 @@ class ExportOne(Action):
         element = self._add_tag(parent, tag, text)
         return element
 
-    def _try_clear_tags(self, search: str) -> bool:
-        elements = self._tree.findall(search)
+    def _try_clear_tags(self, tag: str) -> bool:
+        return self._try_clear(self._document.find_all(tag))
+
+    def _try_clear(self, elements: list) -> bool:
         if elements and not self._can_overwrite:
             return False
-        for element in elements:
-            self._tree.remove(element)
+        self._document.remove(elements)
         return True
 
 
@@ -472,18 +647,86 @@ class _ExportType(_PhasedAction):
         self._message = message
 
     def _phases(self) -> Iterator[Action]:
-        type_info = media.TYPE_INFO[self._media_type]
-        items = media.get_all(self._media_type)
+        items = media.PagedItems(self._media_type)
         count = 0
         total = len(items)
-        for item in items:
+        for info in items:
             if _export_all_progress.is_canceled:
                 break
             _export_all_progress.set(self._message, count, total)
-            yield ExportOne(media.MediaInfo(self._media_type, item[type_info.id_name], file=item['file']))
+            yield ExportOne(info)
             count += 1
 
 
+# Overlaps the exports of several items, since most of an export is spent
+# waiting on JSON-RPC and file shares. Items are listed and their NFOs looked
+# up here, exported on worker threads, and recorded back here as they
+# finish, with only a bounded number in flight at once.
+class _PipelinedExportType(Action):
+
+    _type: Final = 'Pipelined Export Type'
+
+    def __init__(self, type_: str, message: int):
+        super().__init__()
+        self._media_type = type_
+        self._message = message
+
+    def run(self, data: Optional[dict] = None) -> bool:
+        del data
+        threads = settings.performance.export_threads
+        max_in_flight = threads * 2
+
+        items = media.PagedItems(self._media_type)
+        total = len(items)
+        if total == 0:
+            return True
+        count = 0
+        in_flight = set()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            try:
+                _export_all_progress.set(self._message, count, total)
+                for info in items:
+                    if _export_all_progress.is_canceled:
+                        break
+
+                    # Looked up here since the NFO index isn't thread safe
+                    _ = info.nfo
+                    in_flight.add(pool.submit(self._export, info))
+
+                    if len(in_flight) >= max_in_flight:
+                        count += self._record(in_flight, concurrent.futures.FIRST_COMPLETED)
+                        _export_all_progress.set(self._message, count, total)
+
+                if _export_all_progress.is_canceled:
+                    for future in in_flight:
+                        future.cancel()
+                self._record(in_flight, concurrent.futures.ALL_COMPLETED)
+            except BaseException:
+                for future in in_flight:
+                    future.cancel()
+                raise
+
+        return True
+
+    @staticmethod
+    def _export(info: media.MediaInfo) -> (ExportOne, Optional[_ExportResult]):
+        action = ExportOne(info)
+        return action, action.export()
+
+    @staticmethod
+    def _record(in_flight: set, return_when: str) -> int:
+        done, _ = concurrent.futures.wait(in_flight, return_when=return_when)
+        in_flight.difference_update(done)
+        for future in done:
+            if future.cancelled():
+                continue
+            action, result = future.result()
+            if result is not None:
+                action.record(result)
+        return len(done)
+
+
 class ExportAll(_PhasedAction):
 
     _type: Final = 'Export All'
@@ -498,7 +741,10 @@ class ExportAll(_PhasedAction):
         for type_, message in self._types_to_import.items():
             if _export_all_progress.is_canceled:
                 break
-            yield _ExportType(type_=type_, message=message)
+            if settings.performance.export_threads > 1:
+                yield _PipelinedExportType(type_=type_, message=message)
+            else:
+                yield _ExportType(type_=type_, message=message)
 
     def _exception(self, error: Exception) -> None:
         if isinstance(error, ActionError):
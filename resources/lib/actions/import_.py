@@ -1,85 +1,181 @@
-from typing import Iterator, Optional, Final
+import xml.etree.ElementTree as ElementTree
+from typing import Generator, Iterator, Optional, Final
+
+import xbmcvfs
 
 import resources.lib.gui as gui
+import resources.lib.nfo_document as nfo_document
 import resources.lib.jsonrpc as jsonrpc
 import resources.lib.media as media
+import resources.lib.settings as settings
 from resources.lib.addon import addon
+from resources.lib.last_known import last_known
 
 from . import *
-from . import _PhasedAction
+from . import _CoroutineAction, _PhasedAction
+
+
+def _request_refresh(info: media.MediaInfo) -> None:
+    parameters = {media.TYPE_INFO[info.type].id_name: info.id}
+    if info.type == 'tvshow':
+        parameters['refreshepisodes'] = True
+
+    try:
+        jsonrpc.request(
+            media.TYPE_INFO[info.type].refresh_method,
+            **parameters
+        )
+        addon.log(f'Import - A refresh has been requested for "{info.file}"', verbose=True)
+    except jsonrpc.RequestError as error:
+        raise ActionError(32007, f'Import - Unable to request refresh for "{info.file}"') from error
 
 
-class ImportOne(Action):
+class ImportOne(_CoroutineAction):
 
     _type: Final = 'Import One'
 
-    def __init__(self, info: media.MediaInfo):
+    _set_details_methods: Final = {
+        'movie': 'VideoLibrary.SetMovieDetails',
+        'episode': 'VideoLibrary.SetEpisodeDetails'
+    }
+
+    # Only syncs may set the watch state alone, since an explicit import is
+    # asked for to pick up everything else from disk as well
+    def __init__(self, info: media.MediaInfo, can_set_watch_state_only: bool = False):
         super().__init__()
         self._info = info
-        self._awaiting_id = None
-
-    def run(self, data: Optional[dict] = None) -> bool:
-        if not self._awaiting:
-            self._request()
-        else:
-            if not data:
-                return False
-
-            if self._info.type == 'tvshow' and data.get('item') and data['item'].get('id') == self._awaiting_id:
-                self._awaiting = None
-                self._awaiting_id = None
-                return False
-            elif data.get('id') == self._awaiting_id:
-                self._awaiting = None
-                self._awaiting_id = None
-                return True
+        self._can_set_watch_state_only = can_set_watch_state_only
+
+    @property
+    def item(self) -> Optional[tuple]:
+        return self._info.type, self._info.id
+
+    # Movies and episodes are replaced when refreshed, so the removal of the
+    # old one is what marks the refresh as done. Shows are updated in place,
+    # and the service still needs to see that update.
+    def _coroutine(self) -> Generator:
+        if (self._can_set_watch_state_only
+                and settings.import_.should_set_watch_state
+                and self._set_watch_state()):
+            return
+
+        _request_refresh(self._info)
+
+        try:
+            if self._info.type == 'tvshow':
+                yield Notification('VideoLibrary.OnUpdate', match=self._is_refreshed_show, consume=False)
+            else:
+                yield Notification('VideoLibrary.OnRemove', match=self._is_refreshed_item)
+        except GeneratorExit:
+            addon.log(f'Import - Gave up waiting for the refresh of "{self._info.file}"')
+            raise
+
+    def _is_refreshed_show(self, data: dict) -> bool:
+        item = data.get('item') or {}
+        return item.get('type', 'tvshow') == 'tvshow' and item.get('id') == self._info.id
+
+    def _is_refreshed_item(self, data: dict) -> bool:
+        return data.get('type', self._info.type) == self._info.type and data.get('id') == self._info.id
+
+    # A refresh rereads everything, so when nothing but the watch state has
+    # changed since the NFO last matched the library, that gets set directly
+    # instead. Returns whether it was.
+    def _set_watch_state(self) -> bool:
+        method = self._set_details_methods.get(self._info.type)
+        last_checksum = last_known.nfo_checksum(self._info.type, self._info.id)
+        if method is None or last_checksum is None or self._info.nfo is None:
+            return False
+
+        with xbmcvfs.File(self._info.nfo) as file:
+            nfo_contents = file.read()
+        try:
+            root = ElementTree.fromstring(nfo_contents)
+        except ElementTree.ParseError:
+            return False
 
+        if nfo_document.content_checksum(root, nfo_document.WATCH_STATE_TAGS) != last_checksum:
             return False
 
-    def _request(self) -> None:
-        parameters = {media.TYPE_INFO[self._info.type].id_name: self._info.id}
-        if self._info.type == 'tvshow':
-            parameters['refreshepisodes'] = True
+        watch_state = self._watch_state(root)
+        if watch_state is None:
+            return False
 
         try:
-            jsonrpc.request(
-                media.TYPE_INFO[self._info.type].refresh_method,
-                **parameters
-            )
-            addon.log(f'Import - A refresh has been requested for "{self._info.file}"', verbose=True)
+            jsonrpc.request(method, **{media.TYPE_INFO[self._info.type].id_name: self._info.id}, **watch_state)
         except jsonrpc.RequestError as error:
-            raise ActionError(32007, f'Import - Unable to request refresh for "{self._info.file}"') from error
+            addon.log(f'Import - Unable to set watch state for "{self._info.file}", refreshing instead: {error}')
+            return False
+        addon.log(f'Import - Watch state has been set for "{self._info.file}"', verbose=True)
+
+        timestamp = self._info.nfo_modification_time()
+        if timestamp is not None:
+            last_known.set_timestamp(self._info.type, self._info.id, timestamp, nfo=self._info.nfo)
+        return True
+
+    # Reads the watch state the way Kodi would, with watched standing in for
+    # a missing play count. Returns None if any of it can't be read.
+    @staticmethod
+    def _watch_state(root: ElementTree.Element) -> Optional[dict]:
+        watch_state = {}
+        try:
+            playcount = root.findtext('playcount')
+            watched = root.findtext('watched')
+            if playcount is not None:
+                watch_state['playcount'] = int(playcount)
+            elif watched is not None:
+                watch_state['playcount'] = 1 if watched.strip().lower() == 'true' else 0
+
+            lastplayed = root.findtext('lastplayed')
+            if lastplayed is not None:
+                watch_state['lastplayed'] = lastplayed.strip()
+
+            userrating = root.findtext('userrating')
+            if userrating is not None and userrating.strip():
+                watch_state['userrating'] = int(userrating)
+        except ValueError:
+            return None
 
-        self._awaiting_id = self._info.id
-        if self._info.type == 'tvshow':
-            self._awaiting = 'VideoLibrary.OnUpdate'
-        else:
-            self._awaiting = 'VideoLibrary.OnRemove'
+        return watch_state
 
 
 _import_all_progress = gui.AllActionProgress(32065)
 
 
-class _ImportType(_PhasedAction):
+# Keeps several refreshes going at once rather than waiting for each before
+# requesting the next. A refresh that never reports back would hold things
+# up forever, so if nothing finishes for a while, whatever is still
+# outstanding is given up on.
+class _ImportType(_CoroutineAction):
 
     _type: Final = 'Import Type'
 
+    _timeout: Final = 120  # Seconds
+
     def __init__(self, type_: str, message: int):
         super().__init__()
         self._media_type = type_
         self._message = message
 
-    def _phases(self) -> Iterator[Action]:
-        type_info = media.TYPE_INFO[self._media_type]
-        items = media.get_all(self._media_type)
-        count = 0
-        total = len(items)
-        for item in items:
+        self._count = 0
+        self._total = 0
+
+    def _coroutine(self) -> Generator:
+        items = media.PagedItems(self._media_type, with_details=False)
+        self._total = len(items)
+        yield Gather(self._imports(items), limit=settings.performance.import_window, idle_timeout=self._timeout)
+
+    def _imports(self, items: media.PagedItems) -> Iterator[Generator]:
+        for info in items:
             if _import_all_progress.is_canceled:
                 break
-            _import_all_progress.set(self._message, count, total)
-            yield ImportOne(media.MediaInfo(self._media_type, item[type_info.id_name], file=item['file']))
-            count += 1
+            yield self._import(info)
+
+    def _import(self, info: media.MediaInfo) -> Generator:
+        _import_all_progress.set(self._message, self._count, self._total)
+        try:
+            yield ImportOne(info)
+        finally:
+            self._count += 1
 
 
 class ImportAll(_PhasedAction):
@@ -1,35 +1,43 @@
-from typing import Iterator, Final
+import datetime
+from typing import Generator, Iterator, Final, Optional
 
 import resources.lib.gui as gui
 import resources.lib.jsonrpc as jsonrpc
 import resources.lib.media as media
 import resources.lib.settings as settings
 import resources.lib.utcdt as utcdt
-from resources.lib.last_known import last_known
+from resources.lib.addon import addon
+from resources.lib.last_known import last_known, SyncCheckpoint
+from resources.lib.nfo_index import nfo_index
 from resources.lib.timestamps import timestamps
 
 from . import *
-from . import _PhasedAction, _RequestResponseAction
+from . import _CoroutineAction, _PhasedAction
 
 
 class SyncOne(_PhasedAction):
 
     _type: Final = 'Sync One'
 
-    def __init__(self, info: media.MediaInfo):
+    def __init__(self, info: media.MediaInfo, should_check_export: bool = True):
         super().__init__()
         self._info = info
+        self._should_check_export = should_check_export
+
+    @property
+    def item(self) -> Optional[tuple]:
+        return self._info.type, self._info.id
 
     def _phases(self) -> Iterator[Action]:
         should_import = self._item_requires_import()
-        should_export = self._item_requires_export()
+        should_export = self._should_check_export and self._item_requires_export()
 
         if should_export:
             overwrite = not should_import if settings.sync.should_import_first else None
-            yield ExportOne(self._info, overwrite=overwrite)
+            yield ExportOne(self._info, overwrite=overwrite, only_changed=True)
 
         if should_import:
-            yield ImportOne(self._info)
+            yield ImportOne(self._info, can_set_watch_state_only=True)
 
     def _exception(self, error: Exception) -> None:
         if isinstance(error, ActionError):
@@ -54,6 +62,20 @@ class SyncOne(_PhasedAction):
         last_checksum = last_known.checksum(self._info.type, self._info.id)
 
         if last_checksum == self._info.checksum:
+            last_known.clear_dirty(self._info.type, self._info.id)
+            return False
+
+        # Checksums from before the current format can't be compared directly,
+        # so they're checked against the old calculation and brought up to date
+        if (last_checksum is not None
+                and last_known.checksum_version(self._info.type, self._info.id) < media.CHECKSUM_VERSION
+                and last_checksum == self._info.legacy_checksum):
+            last_known.set_checksum(
+                self._info.type,
+                self._info.id,
+                self._info.checksum,
+                self._info.section_checksums
+            )
             return False
 
         return True
@@ -62,34 +84,63 @@ class SyncOne(_PhasedAction):
 _sync_progress: Final = gui.SyncProgress()
 
 
-class _Clean(_RequestResponseAction):
+class _Clean(_CoroutineAction):
 
     _type: Final = 'Clean'
 
-    def _request(self) -> None:
+    def _coroutine(self) -> Generator:
         _sync_progress.set(32003, 0, 1)
         jsonrpc.request('VideoLibrary.Clean', showdialogs=False)
-        self._awaiting = 'VideoLibrary.OnCleanFinished'
+        yield Notification('VideoLibrary.OnCleanFinished')
+
+
+def _is_incremental(scan_time: utcdt.UtcDt) -> bool:
+    full_sync_interval = settings.performance.full_sync_interval
+    return (
+        full_sync_interval > 0
+        and scan_time - timestamps.last_full_sync < datetime.timedelta(days=full_sync_interval)
+    )
 
 
 class _SyncChangesByType(_PhasedAction):
 
     _type: Final = 'Sync Changes By Type'
 
-    def __init__(self, type_: str, message: int):
+    def __init__(
+            self,
+            type_: str,
+            message: int,
+            scan_time: utcdt.UtcDt,
+            resume_after: Optional[int] = None,
+            is_incremental: bool = False
+    ):
         super().__init__()
         self._media_type = type_
         self._message = message
+        self._scan_time = scan_time
+        self._resume_after = resume_after
+        self._is_incremental = is_incremental
 
+    # Incremental syncs only check items the library has reported changes
+    # to, or that have never been checked, for export. Everything still gets
+    # checked for NFO changes, which doesn't need the item's details.
     def _phases(self) -> Iterator[Action]:
-        type_info = media.TYPE_INFO[self._media_type]
-        items = media.get_all(self._media_type)
+        items = media.PagedItems(self._media_type, with_details=not self._is_incremental)
         count = 0
         total = len(items)
-        for item in items:
+        for info in items:
             _sync_progress.set(self._message, count, total)
-            yield SyncOne(media.MediaInfo(self._media_type, item[type_info.id_name], file=item['file']))
             count += 1
+            if self._resume_after is not None and count <= self._resume_after:
+                continue
+
+            should_check_export = (
+                not self._is_incremental
+                or last_known.is_dirty(self._media_type, info.id)
+                or last_known.checksum(self._media_type, info.id) is None
+            )
+            yield SyncOne(info, should_check_export=should_check_export)
+            last_known.set_checkpoint(SyncCheckpoint(scan_time=self._scan_time, type=self._media_type, position=count))
 
 
 class _SyncChanges(_PhasedAction):
@@ -102,22 +153,54 @@ class _SyncChanges(_PhasedAction):
         'episode': 32084
     }
 
+    # A sync that was interrupted picks up after the last item it finished,
+    # keeping its original start time so that nothing changed since then
+    # gets missed by the next one. Items added or removed in the meantime can
+    # shift a few items into the part already done, which the next sync
+    # then catches.
     def _phases(self) -> Iterator[Action]:
-        scan_time = utcdt.now()
+        checkpoint = last_known.checkpoint
+        if checkpoint is None:
+            scan_time = utcdt.now()
+        else:
+            scan_time = checkpoint.scan_time
+            addon.log(f'Sync - Resuming after {checkpoint.type} number {checkpoint.position}', verbose=True)
 
+        is_incremental = _is_incremental(scan_time)
+
+        types = list(self._types_to_sync)
         for type_, message in self._types_to_sync.items():
-            yield _SyncChangesByType(type_=type_, message=message)
+            resume_after = None
+            if checkpoint is not None and checkpoint.type in types:
+                if types.index(type_) < types.index(checkpoint.type):
+                    continue
+                if type_ == checkpoint.type:
+                    resume_after = checkpoint.position
+            yield _SyncChangesByType(
+                type_=type_,
+                message=message,
+                scan_time=scan_time,
+                resume_after=resume_after,
+                is_incremental=is_incremental
+            )
 
         timestamps.last_sync = scan_time
+        if not is_incremental:
+            timestamps.last_full_sync = scan_time
+
+        last_known.purge()
+        nfo_index.prune()
+        nfo_index.write()
+        last_known.clear_checkpoint()
 
 
-class _Scan(_RequestResponseAction):
+class _Scan(_CoroutineAction):
 
     _type: Final = 'Scan'
 
-    def _request(self) -> None:
+    def _coroutine(self) -> Generator:
         jsonrpc.request('VideoLibrary.Scan', showdialogs=settings.ui.should_show_sync)
-        self._awaiting = 'VideoLibrary.OnScanFinished'
+        yield Notification('VideoLibrary.OnScanFinished')
 
 
 class SyncAll(_PhasedAction):
@@ -128,12 +211,34 @@ class SyncAll(_PhasedAction):
         super().__init__()
         self._should_skip_scan = should_skip_scan
 
+    def merge(self, other: Action) -> None:
+        if isinstance(other, SyncAll) and not other._should_skip_scan:
+            self._should_skip_scan = False
+
+    # Only a sync that will check every item for both import and export
+    # stands in for a sync of one. A resumed sync skips the items it already
+    # did, and an incremental one skips the export check of unchanged items.
+    # An export that wasn't limited to changes always writes the NFO, which
+    # a sync only does when the item has changed.
+    def covers(self, other: Action) -> bool:
+        if last_known.checkpoint is not None or _is_incremental(utcdt.now()):
+            return False
+        if isinstance(other, SyncOne):
+            return settings.sync.should_import and settings.sync.should_export
+        if isinstance(other, ExportOne):
+            return other.only_changed and settings.sync.should_export
+        return False
+
     def _phases(self) -> Iterator[Action]:
-        if settings.sync.should_clean:
+        # A resumed sync already cleaned before it was interrupted
+        if settings.sync.should_clean and last_known.checkpoint is None:
             yield _Clean()
 
         if settings.sync.should_import or settings.sync.should_export:
             yield _SyncChanges()
+        else:
+            # Nothing is left to resume with both turned off
+            last_known.clear_checkpoint()
 
         _sync_progress.close()
 
@@ -1,6 +1,7 @@
 from typing import Optional
 
 from resources.lib.last_known import last_known
+from resources.lib.nfo_index import nfo_index
 
 from . import *
 
@@ -11,5 +12,6 @@ class WriteChanges(Action):
 
     def run(self, data: Optional[dict] = None) -> bool:
         del data
-        last_known.write_changes()
+        last_known.write_settled_changes()
+        nfo_index.write()
         return True
@@ -18,25 +18,31 @@ class Alarm(xbmc.Monitor):
         self._message = message
         self._data = data
 
-        self._minutes = 0
+        self._seconds = 0
 
     @property
     def is_active(self) -> bool:
-        return bool(self._minutes)
+        return bool(self._seconds)
 
     @property
     def minutes(self) -> int:
-        return self._minutes
+        return self._seconds // 60
 
     def set(self, minutes):
+        self.set_seconds(minutes * 60)
+
+    # AlarmClock takes plain numbers as minutes, but also accepts an mm:ss
+    # time string for anything shorter
+    def set_seconds(self, seconds: int):
         self.cancel()
-        if minutes > 0:
-            self._minutes = minutes
-            xbmc.executebuiltin(f'AlarmClock({self._name},{self._command},{self._minutes},silent{self._loop})')
+        if seconds > 0:
+            self._seconds = seconds
+            time = seconds // 60 if seconds % 60 == 0 else f'{seconds // 60}:{seconds % 60:02d}'
+            xbmc.executebuiltin(f'AlarmClock({self._name},{self._command},{time},silent{self._loop})')
 
     def cancel(self):
         xbmc.executebuiltin(f'CancelAlarm({self._name},silent)')
-        self._minutes = 0
+        self._seconds = 0
 
     def onNotification(self, sender: str, method: str, data: str) -> None:
         if method != jsonrpc.INTERNAL_METHODS.alarm.recv:
@@ -46,7 +52,7 @@ class Alarm(xbmc.Monitor):
             return
 
         if not self._loop:
-            self._minutes = 0
+            self._seconds = 0
 
         if self._data:
             jsonrpc.notify(message=self._message, data=self._data)
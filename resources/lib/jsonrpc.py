@@ -1,3 +1,4 @@
+import collections
 import json
 from typing import Final
 
@@ -27,6 +28,8 @@ class _InternalMethods:
     export_one: Final = _Method('Export')
     export_all: Final = _Method('ExportAll')
     write_changes: Final = _Method('WriteChanges')
+    timer: Final = _Method('Timer')
+    updates_settled: Final = _Method('UpdatesSettled')
 
 
 INTERNAL_METHODS: Final = _InternalMethods()
@@ -36,13 +39,20 @@ class RequestError(Exception):
     pass
 
 
-def request(method: str, **params) -> dict:
-    contents = {
+Call = collections.namedtuple('Call', ['method', 'params'])
+
+
+def _contents(method: str, params: dict, id_: int) -> dict:
+    return {
         'jsonrpc': '2.0',
         'method': method,
         'params': params,
-        'id': 1
+        'id': id_
     }
+
+
+def request(method: str, **params) -> dict:
+    contents = _contents(method, params, 1)
     raw_response = xbmc.executeJSONRPC(json.dumps(contents))
     response = json.loads(raw_response)
     if 'error' in response:
@@ -51,6 +61,41 @@ def request(method: str, **params) -> dict:
     return response['result']
 
 
+# Sends all the calls in a single JSON-RPC batch. Results come back in the
+# same order as the calls, with any call that failed represented by the
+# RequestError describing its failure rather than raising, so that one bad
+# call doesn't throw away the rest of the batch.
+def request_batch(calls: list) -> list:
+    if not calls:
+        return []
+
+    contents = [_contents(call.method, call.params, id_) for id_, call in enumerate(calls)]
+    raw_response = xbmc.executeJSONRPC(json.dumps(contents))
+    responses = json.loads(raw_response)
+
+    # A malformed batch gets a single error response rather than a list
+    if isinstance(responses, dict):
+        raise RequestError(f'JSONRPC batch request failed.\nRequest: {contents}\nResponse: {responses}')
+
+    results = [None] * len(calls)
+    for response in responses:
+        id_ = response.get('id')
+        if not isinstance(id_, int) or not 0 <= id_ < len(calls):
+            continue
+        if 'error' in response:
+            results[id_] = RequestError(
+                f'JSONRPC request failed.\nRequest: {contents[id_]}\nResponse: {response}'
+            )
+        else:
+            results[id_] = response['result']
+
+    for id_, result in enumerate(results):
+        if result is None:
+            results[id_] = RequestError(f'JSONRPC request received no response.\nRequest: {contents[id_]}')
+
+    return results
+
+
 def notify(message: str, data: dict = None) -> None:
     notification = {
         'sender': addon.id,
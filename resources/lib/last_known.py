@@ -1,158 +1,597 @@
-from typing import Final, Optional
+import array
+import bisect
+import collections
+import json
+import os
+import sqlite3
+import struct
+import time
+from typing import Final, Iterable, Iterator, Optional
 
 import xbmcvfs
 
 import resources.lib.jsonrpc as jsonrpc
 import resources.lib.media as media
+import resources.lib.settings as settings
 import resources.lib.utcdt as utcdt
 from resources.lib.addon import addon
 from resources.lib.alarm import Alarm
 
 
-class _NoMoreBytes(Exception):
-    pass
+# Records are held column-wise in parallel arrays kept sorted by ID, with a
+# status byte per record saying which fields are present. This costs a few
+# bytes per record rather than the few hundred a dict per record would.
+# Section checksums are held flat, media.SECTIONS values per record.
+class _Records:
 
+    # The checksum version and dirty flag have no columns of their own. The
+    # checksum version bit being set means the checksum is in the current
+    # format, and the dirty bit that the item changed since it was checked.
+    bits: Final = {
+        'checksum': 1 << 0,
+        'timestamp': 1 << 1,
+        'checksum_version': 1 << 2,
+        'sections': 1 << 3,
+        'nfo_checksum': 1 << 4,
+        'dirty': 1 << 5
+    }
 
-class _ByteReader:
-    def __init__(self, bytes_: bytearray):
-        self._bytes = bytes_
-        self._cursor = 0
+    _flags: Final = {
+        'checksum_version': media.CHECKSUM_VERSION,
+        'dirty': 1
+    }
 
-    def advance(self, bytes_: int) -> None:
-        self._cursor += bytes_
+    _section_count: Final = len(media.SECTIONS)
 
-    def read(self, bytes_: int) -> bytearray:
-        end_point = self._cursor + bytes_
-        result = self._bytes[self._cursor:end_point]
-        self._cursor = end_point
+    def __init__(self):
+        self._ids = array.array('I')
+        self._statuses = array.array('B')
+        self._checksums = array.array('I')
+        self._timestamps = array.array('Q')
+        self._nfo_checksums = array.array('I')
+        self._sections = array.array('I')
 
-        if not result:
-            raise _NoMoreBytes
+    def __len__(self) -> int:
+        return len(self._ids)
 
-        return result
+    def ids(self) -> array.array:
+        return self._ids
 
+    def get(self, id_: int, field: str) -> Optional[int]:
+        index = self._find(id_)
+        if index is None or not self._statuses[index] & self.bits[field]:
+            return None
+        if field in self._flags:
+            return self._flags[field]
+        if field == 'sections':
+            return tuple(self._sections[self._section_slice(index)])
+        return self._column(field)[index]
+
+    def set(self, id_: int, field: str, value) -> None:
+        index = self._find(id_)
+        if index is None:
+            index = self._insert(id_)
+        self._statuses[index] |= self.bits[field]
+        if field == 'sections':
+            self._sections[self._section_slice(index)] = array.array('I', value)
+        elif field not in self._flags:
+            self._column(field)[index] = value
+
+    # A record left with nothing set is removed, the same as a journal
+    # record with nothing set would remove it
+    def unset(self, id_: int, field: str) -> None:
+        index = self._find(id_)
+        if index is None:
+            return
+        self._statuses[index] &= ~self.bits[field]
+        if not self._statuses[index]:
+            self.remove(id_)
+
+    # Sets every field of a record at once, as stored in a tracker file
+    def put(self, id_: int, status: int, checksum: int, timestamp: int, nfo_checksum: int, sections: Iterable) -> None:
+        index = self._find(id_)
+        if index is None:
+            index = self._insert(id_)
+        self._statuses[index] = status
+        self._checksums[index] = checksum
+        self._timestamps[index] = timestamp
+        self._nfo_checksums[index] = nfo_checksum
+        self._sections[self._section_slice(index)] = array.array('I', sections)
+
+    def remove(self, id_: int) -> None:
+        index = self._find(id_)
+        if index is None:
+            return
+        del self._ids[index]
+        del self._statuses[index]
+        del self._checksums[index]
+        del self._timestamps[index]
+        del self._nfo_checksums[index]
+        del self._sections[self._section_slice(index)]
+
+    def row(self, id_: int) -> (int, int, int, int, Iterable):
+        index = self._find(id_)
+        if index is None:
+            return 0, 0, 0, 0, (0,) * self._section_count
+        return (
+            self._statuses[index],
+            self._checksums[index],
+            self._timestamps[index],
+            self._nfo_checksums[index],
+            self._sections[self._section_slice(index)]
+        )
 
+    def rows(self) -> Iterator[tuple]:
+        sections = (self._sections[self._section_slice(index)] for index in range(len(self._ids)))
+        return zip(self._ids, self._statuses, self._checksums, self._timestamps, self._nfo_checksums, sections)
+
+    # Bulk loading appends everything and sorts once at the end, since
+    # snapshots are normally already in order and this avoids inserting
+    # records one at a time
+    def load(self, rows: Iterable) -> None:
+        is_sorted = True
+        last_id = -1
+        for id_, status, checksum, timestamp, nfo_checksum, sections in rows:
+            if id_ <= last_id:
+                is_sorted = False
+            last_id = id_
+            self._ids.append(id_)
+            self._statuses.append(status)
+            self._checksums.append(checksum)
+            self._timestamps.append(timestamp)
+            self._nfo_checksums.append(nfo_checksum)
+            self._sections.extend(sections)
+
+        if not is_sorted:
+            order = {id_: index for index, id_ in enumerate(self._ids)}
+            indexes = [order[id_] for id_ in sorted(order)]
+            sections = array.array('I')
+            for index in indexes:
+                sections.extend(self._sections[self._section_slice(index)])
+            self._ids = array.array('I', (self._ids[index] for index in indexes))
+            self._statuses = array.array('B', (self._statuses[index] for index in indexes))
+            self._checksums = array.array('I', (self._checksums[index] for index in indexes))
+            self._timestamps = array.array('Q', (self._timestamps[index] for index in indexes))
+            self._nfo_checksums = array.array('I', (self._nfo_checksums[index] for index in indexes))
+            self._sections = sections
+
+    def _column(self, field: str) -> array.array:
+        if field == 'checksum':
+            return self._checksums
+        if field == 'nfo_checksum':
+            return self._nfo_checksums
+        return self._timestamps
+
+    def _section_slice(self, index: int) -> slice:
+        return slice(index * self._section_count, (index + 1) * self._section_count)
+
+    def _find(self, id_: int) -> Optional[int]:
+        index = bisect.bisect_left(self._ids, id_)
+        if index < len(self._ids) and self._ids[index] == id_:
+            return index
+        return None
+
+    def _insert(self, id_: int) -> int:
+        index = bisect.bisect_left(self._ids, id_)
+        self._ids.insert(index, id_)
+        self._statuses.insert(index, 0)
+        self._checksums.insert(index, 0)
+        self._timestamps.insert(index, 0)
+        self._nfo_checksums.insert(index, 0)
+        position = index * self._section_count
+        self._sections[position:position] = array.array('I', (0,) * self._section_count)
+        return index
+
+
+# Trackers are stored as a snapshot of every record plus a journal that
+# changed records get appended to, so that a write only costs as much as
+# what changed. Both files share the same record layout, with a record that
+# has no fields set in the journal marking its ID as removed. Once the
+# journal grows large enough, it gets folded back into a new snapshot.
 class _Tracker:
     _version_bytes: Final = 2
-    _id_bytes: Final = 4
-    _status_bytes: Final = 1
-    _checksum_bytes: Final = 4
-    _timestamp_bytes: Final = 5
 
-    _checksum_index: Final = 0
-    _timestamp_index: Final = 1
+    # ID, status bits, checksum, and the timestamp split into its low 4 bytes
+    # and high byte, since struct has no 5 byte integer. Version 1 added the
+    # section checksums and version 2 the NFO checksum.
+    _records_by_version: Final = {
+        0: struct.Struct('<IBIIB'),
+        1: struct.Struct(f'<IBIIB{len(media.SECTIONS)}I'),
+        2: struct.Struct(f'<IBIIB{len(media.SECTIONS)}II')
+    }
 
-    _version: Final = 0
+    _version: Final = 2
+    _record: Final = _records_by_version[_version]
+
+    _max_journal_bytes: Final = 64 * 1024
 
     def __init__(self, type_: str):
-        self._contents = {}
-        self._has_unwritten_changes = False
+        self._records = _Records()
+        self._changed = set()
         self._type = type_
         self._file: Final = xbmcvfs.translatePath(f'{addon.profile}{self._type}.dat')
+        self._journal: Final = xbmcvfs.translatePath(f'{addon.profile}{self._type}.journal')
+        self._journal_size = 0
 
-        if not xbmcvfs.exists(self._file):
-            return
+        self.is_new: Final = not xbmcvfs.exists(self._file) and not xbmcvfs.exists(self._journal)
+
+        if xbmcvfs.exists(self._file):
+            with xbmcvfs.File(self._file) as file:
+                self._import_bytes(file.readBytes())
 
-        with xbmcvfs.File(self._file) as file:
-            bytes_ = file.readBytes()
-            self._import_bytes(bytes_)
+        if xbmcvfs.exists(self._journal):
+            with xbmcvfs.File(self._journal) as file:
+                bytes_ = file.readBytes()
+            is_appendable = self._import_bytes(bytes_, is_journal=True)
+            self._journal_size = len(bytes_)
+
+            # Appending after a partial record would leave every later record
+            # misaligned, as would appending to a journal in an older format,
+            # so those get folded in right away
+            if not is_appendable:
+                self._compact()
 
     def get(self, id_: int, field: str) -> Optional[int]:
-        record = self._contents.get(id_, None)
-        if record is None:
-            return None
-        return record.get(field, None)
+        return self._records.get(id_, field)
 
     def set(self, id_: int, field: str, value: int) -> None:
-        self._has_unwritten_changes = True
-        if id_ not in self._contents:
-            self._contents[id_] = {}
-        self._contents[id_][field] = value
+        self._changed.add(id_)
+        self._records.set(id_, field, value)
 
-    def write(self) -> None:
-        if not self._has_unwritten_changes:
-            return
+    def unset(self, id_: int, field: str) -> None:
+        self._changed.add(id_)
+        self._records.unset(id_, field)
 
-        bytes_ = bytearray()
+    # Records are fixed size, so there's no room to keep the NFO path
+    def set_nfo(self, id_: int, path: str) -> None:
+        pass
 
-        bytes_.extend(self._version.to_bytes(self._version_bytes, byteorder='little'))
+    def rows(self) -> Iterator[tuple]:
+        return self._records.rows()
 
-        to_purge = []
-        for id_, fields in self._contents.items():
-            if not media.exists(self._type, id_):
-                to_purge.append(id_)
-                continue
+    # Takes on the records of another tracker, replacing any already here
+    def migrate(self, rows: Iterable) -> None:
+        self._records = _Records()
+        self._records.load(rows)
+        self._changed.clear()
+        self._compact()
+
+    # Moves the tracker files out of the way once they've been migrated
+    def retire(self) -> None:
+        for file in (self._file, self._journal):
+            if xbmcvfs.exists(file):
+                xbmcvfs.rename(file, f'{file}.migrated')
+
+    def write(self) -> None:
+        if not self._changed:
+            return
 
-            bytes_.extend(id_.to_bytes(self._id_bytes, byteorder='little'))
+        rows = ((id_, *self._records.row(id_)) for id_ in sorted(self._changed))
+        bytes_ = self._export_bytes(rows, len(self._changed), with_version=self._journal_size == 0)
 
-            status_bits = 0
+        # xbmcvfs can only truncate files, so appending uses a regular file.
+        # The profile folder is always local, so this is fine.
+        xbmcvfs.mkdir(addon.profile)
+        try:
+            with open(self._journal, 'ab') as file:
+                file.write(bytes_)
+        except OSError as error:
+            addon.log(f'Unable to write tracker journal "{self._journal}": {error}')
+            addon.notify(32006)
+            return
 
-            checksum = fields.get('checksum', None)
-            if checksum is None:
-                checksum = 0
-            else:
-                status_bits = self._set_bit(status_bits, self._checksum_index)
+        self._changed.clear()
+        self._journal_size += len(bytes_)
 
-            timestamp = fields.get('timestamp', None)
-            if timestamp is None:
-                timestamp = 0
-            else:
-                status_bits = self._set_bit(status_bits, self._timestamp_index)
+        if self._journal_size > self._max_journal_bytes:
+            self._compact()
 
-            bytes_.extend(status_bits.to_bytes(self._status_bytes, byteorder='little'))
-            bytes_.extend(checksum.to_bytes(self._checksum_bytes, byteorder='little'))
-            bytes_.extend(timestamp.to_bytes(self._timestamp_bytes, byteorder='little'))
+    def purge(self, ids: set) -> None:
+        for id_ in set(self._records.ids()) - ids:
+            self._records.remove(id_)
+            self._changed.add(id_)
 
-        for id_ in to_purge:
-            del self._contents[id_]
+    # The journal is only removed once the new snapshot has replaced the old
+    # one. Since everything in the journal is already reflected in the
+    # snapshot, replaying it after being interrupted between the two steps
+    # gives the same result.
+    def _compact(self) -> None:
+        bytes_ = self._export_bytes(self._records.rows(), len(self._records))
 
-        xbmcvfs.mkdir(addon.profile)
-        with xbmcvfs.File(self._file, 'w') as file:
+        temporary_file = f'{self._file}.tmp'
+        with xbmcvfs.File(temporary_file, 'w') as file:
             success = file.write(bytes_)
 
         if not success:
             addon.log(f'Unable to write tracker file "{self._file}"')
             addon.notify(32006)
+            return
 
-    def _import_bytes(self, bytes_: bytearray) -> None:
-        byte_reader = _ByteReader(bytes_)
-        byte_reader.advance(self._version_bytes)  # skip over version info, it's not used right now
+        try:
+            os.replace(temporary_file, self._file)
+            if os.path.exists(self._journal):
+                os.remove(self._journal)
+        except OSError as error:
+            addon.log(f'Unable to compact tracker journal "{self._journal}": {error}')
+            return
 
-        while True:
-            record = {}
+        self._journal_size = 0
 
-            try:
-                id_ = int.from_bytes(byte_reader.read(self._id_bytes), byteorder='little')
-                status = int.from_bytes(byte_reader.read(self._status_bytes), byteorder='little')
-                checksum = int.from_bytes(byte_reader.read(self._checksum_bytes), byteorder='little')
-                timestamp = int.from_bytes(byte_reader.read(self._timestamp_bytes), byteorder='little')
-            except _NoMoreBytes:
-                break
+    def _export_bytes(self, rows: Iterable, count: int, with_version: bool = True) -> bytearray:
+        offset = self._version_bytes if with_version else 0
+        bytes_ = bytearray(offset + count * self._record.size)
+        if with_version:
+            bytes_[0:offset] = self._version.to_bytes(self._version_bytes, byteorder='little')
+
+        pack_into = self._record.pack_into
+        for id_, status, checksum, timestamp, nfo_checksum, sections in rows:
+            pack_into(
+                bytes_, offset,
+                id_, status, checksum, timestamp & 0xFFFFFFFF, timestamp >> 32, *sections, nfo_checksum
+            )
+            offset += self._record.size
+
+        return bytes_
+
+    # Returns whether the bytes were complete and in the current format
+    def _import_bytes(self, bytes_: bytearray, is_journal: bool = False) -> bool:
+        if len(bytes_) < self._version_bytes:
+            return False
+
+        version = int.from_bytes(bytes_[0:self._version_bytes], byteorder='little')
+        record = self._records_by_version.get(version)
+        if record is None:
+            addon.log(f'Tracker file for {self._type} is in an unknown format (version {version}) and was ignored')
+            return False
+
+        # Any partial record at the end means a write was interrupted, so
+        # it's ignored
+        records = memoryview(bytes_)[self._version_bytes:]
+        is_complete = len(records) % record.size == 0
+        records = records[:len(records) - len(records) % record.size]
+
+        # Fields added by later versions are left at zero, with their status
+        # bits unset
+        section_count = len(media.SECTIONS)
+        no_sections = (0,) * section_count
+        rows = (
+            (
+                id_,
+                status,
+                checksum,
+                timestamp_low | (timestamp_high << 32),
+                rest[section_count] if len(rest) > section_count else 0,
+                rest[:section_count] or no_sections
+            )
+            for id_, status, checksum, timestamp_low, timestamp_high, *rest in record.iter_unpack(records)
+        )
+
+        if not is_journal:
+            self._records.load(row for row in rows if row[1])
+        else:
+            for id_, status, checksum, timestamp, nfo_checksum, sections in rows:
+                if status:
+                    self._records.put(id_, status, checksum, timestamp, nfo_checksum, sections)
+                else:
+                    self._records.remove(id_)
+
+        return is_complete and version == self._version
+
+
+class _Database:
 
-            if self._get_bit(status, self._checksum_index):
-                record['checksum'] = checksum
-            if self._get_bit(status, self._timestamp_index):
-                record['timestamp'] = timestamp
-            if record:
-                self._contents[id_] = record
+    @staticmethod
+    def path() -> str:
+        return xbmcvfs.translatePath(f'{addon.profile}last_known.db')
 
-    def _get_bit(self, bit_array: int, index: int) -> int:
-        return bit_array & (1 << index)
+    def __init__(self):
+        self._file: Final = self.path()
+
+        xbmcvfs.mkdir(addon.profile)
+        self.connection: Final = sqlite3.connect(self._file)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+    def commit(self) -> None:
+        try:
+            self.connection.commit()
+        except sqlite3.Error as error:
+            addon.log(f'Unable to write tracker database "{self._file}": {error}')
+            addon.notify(32006)
+
+    # Closes the database and moves it out of the way once it's been
+    # migrated, so that switching back to it later migrates afresh rather
+    # than picking up records that have gone stale
+    def retire(self) -> None:
+        self.connection.close()
+        try:
+            os.replace(self._file, f'{self._file}.migrated')
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(self._file + suffix):
+                    os.remove(self._file + suffix)
+        except OSError as error:
+            addon.log(f'Unable to move aside tracker database "{self._file}": {error}')
+
+
+class _SqliteTracker:
+
+    _fields: Final = ('checksum', 'checksum_version', 'timestamp', 'nfo', 'sections', 'nfo_checksum', 'dirty')
+    _sections: Final = struct.Struct(f'<{len(media.SECTIONS)}I')
+
+    def __init__(self, database: _Database, type_: str):
+        self._database = database
+        self._connection = database.connection
+        self._type: Final = type_
+
+        is_new = self._connection.execute(
+            'SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = ?',
+            (self._type,)
+        ).fetchone() is None
+
+        self._connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {self._type} '
+            f'(id INTEGER PRIMARY KEY, checksum INTEGER, timestamp INTEGER, nfo TEXT)'
+        )
+        # Nothing looks items up by timestamp any more, so the index would
+        # only slow down writes
+        self._connection.execute(f'DROP INDEX IF EXISTS {self._type}_timestamp')
+
+        columns = {row[1] for row in self._connection.execute(f'PRAGMA table_info({self._type})')}
+        if 'checksum_version' not in columns:
+            self._connection.execute(f'ALTER TABLE {self._type} ADD COLUMN checksum_version INTEGER')
+        if 'sections' not in columns:
+            self._connection.execute(f'ALTER TABLE {self._type} ADD COLUMN sections BLOB')
+        if 'nfo_checksum' not in columns:
+            self._connection.execute(f'ALTER TABLE {self._type} ADD COLUMN nfo_checksum INTEGER')
+        if 'dirty' not in columns:
+            self._connection.execute(f'ALTER TABLE {self._type} ADD COLUMN dirty INTEGER')
+
+        if is_new:
+            self._migrate()
+        self._database.commit()
 
-    def _set_bit(self, bit_array: int, index: int) -> int:
-        return bit_array | (1 << index)
+    def get(self, id_: int, field: str) -> Optional[int]:
+        row = self._connection.execute(
+            f'SELECT {self._column(field)} FROM {self._type} WHERE id = ?',
+            (id_,)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        if field == 'sections':
+            return self._sections.unpack(row[0])
+        return row[0]
+
+    def set(self, id_: int, field: str, value) -> None:
+        if field == 'sections':
+            value = self._sections.pack(*value)
+        self._connection.execute(f'INSERT OR IGNORE INTO {self._type} (id) VALUES (?)', (id_,))
+        self._connection.execute(
+            f'UPDATE {self._type} SET {self._column(field)} = ? WHERE id = ?',
+            (value, id_)
+        )
 
+    def unset(self, id_: int, field: str) -> None:
+        self._connection.execute(
+            f'UPDATE {self._type} SET {self._column(field)} = NULL WHERE id = ?',
+            (id_,)
+        )
+
+    def set_nfo(self, id_: int, path: str) -> None:
+        self.set(id_, 'nfo', path)
 
+    # Changes accumulate in the open transaction until written
+    def write(self) -> None:
+        self._database.commit()
+
+    def purge(self, ids: set) -> None:
+        tracked = {row[0] for row in self._connection.execute(f'SELECT id FROM {self._type}')}
+        self._connection.executemany(
+            f'DELETE FROM {self._type} WHERE id = ?',
+            ((id_,) for id_ in tracked - ids)
+        )
+
+    # Rows in the same form as _Records.rows
+    def rows(self) -> Iterator[tuple]:
+        no_sections = (0,) * len(media.SECTIONS)
+        rows = self._connection.execute(
+            f'SELECT id, checksum, timestamp, checksum_version, sections, nfo_checksum, dirty '
+            f'FROM {self._type} ORDER BY id'
+        )
+        for id_, checksum, timestamp, checksum_version, sections, nfo_checksum, dirty in rows:
+            status = 0
+            if checksum is not None:
+                status |= _Records.bits['checksum']
+            if timestamp is not None:
+                status |= _Records.bits['timestamp']
+            if checksum_version == media.CHECKSUM_VERSION:
+                status |= _Records.bits['checksum_version']
+            if sections is not None:
+                status |= _Records.bits['sections']
+            if nfo_checksum is not None:
+                status |= _Records.bits['nfo_checksum']
+            if dirty is not None:
+                status |= _Records.bits['dirty']
+            if not status:
+                continue
+            yield (
+                id_,
+                status,
+                checksum or 0,
+                timestamp or 0,
+                nfo_checksum or 0,
+                self._sections.unpack(sections) if sections is not None else no_sections
+            )
+
+    def _column(self, field: str) -> str:
+        if field not in self._fields:
+            raise ValueError(f'Unknown tracker field "{field}"')
+        return field
+
+    # Brings over the records from the tracker files on first use. The old
+    # files are kept, renamed, rather than deleted.
+    def _migrate(self) -> None:
+        tracker = _Tracker(self._type)
+        rows = list(tracker.rows())
+        if not rows:
+            return
+
+        checksum_bit = _Records.bits['checksum']
+        timestamp_bit = _Records.bits['timestamp']
+        version_bit = _Records.bits['checksum_version']
+        sections_bit = _Records.bits['sections']
+        nfo_checksum_bit = _Records.bits['nfo_checksum']
+        dirty_bit = _Records.bits['dirty']
+        self._connection.executemany(
+            f'INSERT OR REPLACE INTO {self._type} '
+            f'(id, checksum, timestamp, checksum_version, sections, nfo_checksum, dirty) '
+            f'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (
+                (
+                    id_,
+                    checksum if status & checksum_bit else None,
+                    timestamp if status & timestamp_bit else None,
+                    media.CHECKSUM_VERSION if status & version_bit else None,
+                    self._sections.pack(*sections) if status & sections_bit else None,
+                    nfo_checksum if status & nfo_checksum_bit else None,
+                    1 if status & dirty_bit else None
+                )
+                for id_, status, checksum, timestamp, nfo_checksum, sections in rows
+            )
+        )
+        self._database.commit()
+
+        tracker.retire()
+        addon.log(f'Migrated {len(rows)} {self._type} records to the tracker database')
+
+
+# How far a full sync got: the time it started at, and how many items of the
+# type it was on were finished. Items are listed in the order they were
+# added, so those first items in that type, and every type before it, are
+# done.
+SyncCheckpoint = collections.namedtuple('SyncCheckpoint', ['scan_time', 'type', 'position'])
+
+
+# Writes are held back until changes have been quiet for a while, so that a
+# burst of changes gets written together. To keep a long run of changes from
+# holding everything in memory indefinitely, they're written straight away
+# once enough have piled up or the oldest has waited too long. The write
+# timer is only armed once per batch rather than reset on every change.
 class _LastKnown:
 
-    _cool_down = 1  # Minutes
+    _quiet_period = 1  # Minutes
+    _max_staleness = 10  # Minutes
+    _max_unwritten = 500  # Changes
+
+    _types: Final = ('movie', 'episode', 'tvshow')
 
     def __init__(self):
-        self._trackers = {
-            'movie': _Tracker('movie'),
-            'episode': _Tracker('episode'),
-            'tvshow': _Tracker('tvshow')
-        }
+        if settings.performance.tracker_storage == settings.TrackerStorageOption.DATABASE:
+            database = _Database()
+            self._trackers = {type_: _SqliteTracker(database, type_) for type_ in self._types}
+        else:
+            self._trackers = {type_: _Tracker(type_) for type_ in self._types}
+            if all(tracker.is_new for tracker in self._trackers.values()) and os.path.exists(_Database.path()):
+                self._migrate_from_database()
 
         self._write_timer = Alarm(
             name='LastKnown.WriteTimer',
@@ -160,14 +599,95 @@ class _LastKnown:
             data={'patient': True}
         )
 
+        self._unwritten = 0
+        self._first_change = None
+        self._last_change = None
+
+        self._checkpoint_file: Final = xbmcvfs.translatePath(f'{addon.profile}sync_checkpoint.json')
+        self._checkpoint = self._read_checkpoint()
+        self._is_checkpoint_changed = False
+
+    # Switching back to tracker files after using the database brings the
+    # records back over, since the files were moved aside when the database
+    # took over from them
+    def _migrate_from_database(self) -> None:
+        database = _Database()
+        for type_, tracker in self._trackers.items():
+            rows = list(_SqliteTracker(database, type_).rows())
+            tracker.migrate(rows)
+            addon.log(f'Migrated {len(rows)} {type_} records from the tracker database')
+        database.retire()
+
+    @property
+    def checkpoint(self) -> Optional[SyncCheckpoint]:
+        return self._checkpoint
+
+    # The checkpoint is written along with the trackers so that it's never
+    # ahead of the records for the items it says are done
+    def set_checkpoint(self, checkpoint: SyncCheckpoint) -> None:
+        self._checkpoint = checkpoint
+        self._is_checkpoint_changed = True
+        self._changed()
+
+    def clear_checkpoint(self) -> None:
+        self._checkpoint = None
+        self._is_checkpoint_changed = True
+        self._write_checkpoint()
+
     def checksum(self, type_: str, id_: int) -> Optional[int]:
         return self._trackers[type_].get(id_, 'checksum')
 
-    def set_checksum(self, type_: str, id_: int, checksum: Optional[int]) -> None:
+    def checksum_version(self, type_: str, id_: int) -> int:
+        version = self._trackers[type_].get(id_, 'checksum_version')
+        if version is None:
+            return 0
+        return version
+
+    def sections(self, type_: str, id_: int) -> Optional[tuple]:
+        return self._trackers[type_].get(id_, 'sections')
+
+    # Returns which of media.SECTIONS differ from when the checksum was last
+    # set, or None if that isn't known
+    def changed_sections(self, info: media.MediaInfo) -> Optional[set]:
+        last_sections = self.sections(info.type, info.id)
+        if last_sections is None:
+            return None
+        return {
+            section for section, last, current in zip(media.SECTIONS, last_sections, info.section_checksums)
+            if last != current
+        }
+
+    def set_checksum(
+            self,
+            type_: str,
+            id_: int,
+            checksum: Optional[int] = None,
+            sections: Optional[tuple] = None
+    ) -> None:
         if checksum is None:
-            checksum = media.MediaInfo(type_, id_).checksum
+            info = media.MediaInfo(type_, id_)
+            checksum = info.checksum
+            sections = info.section_checksums
         self._trackers[type_].set(id_, 'checksum', checksum)
-        self._write_timer.set(self._cool_down)
+        self._trackers[type_].set(id_, 'checksum_version', media.CHECKSUM_VERSION)
+        if sections is not None:
+            self._trackers[type_].set(id_, 'sections', sections)
+        self._trackers[type_].unset(id_, 'dirty')
+        self._changed()
+
+    # Items are marked dirty when the library reports a change to them, and
+    # stop being dirty once their checksum is recorded or found unchanged
+    def is_dirty(self, type_: str, id_: int) -> bool:
+        return self._trackers[type_].get(id_, 'dirty') is not None
+
+    def mark_dirty(self, type_: str, id_: int) -> None:
+        self._trackers[type_].set(id_, 'dirty', 1)
+        self._changed()
+
+    def clear_dirty(self, type_: str, id_: int) -> None:
+        if self.is_dirty(type_, id_):
+            self._trackers[type_].unset(id_, 'dirty')
+            self._changed()
 
     def timestamp(self, type_: str, id_: int) -> Optional[utcdt.UtcDt]:
         epoch_timestamp = self._trackers[type_].get(id_, 'timestamp')
@@ -175,14 +695,121 @@ class _LastKnown:
             return None
         return utcdt.fromtimestamp(epoch_timestamp)
 
-    def set_timestamp(self, type_: str, id_: int, timestamp: utcdt.UtcDt) -> None:
+    def set_timestamp(self, type_: str, id_: int, timestamp: utcdt.UtcDt, nfo: Optional[str] = None) -> None:
         epoch_timestamp = int(timestamp.timestamp())
         self._trackers[type_].set(id_, 'timestamp', epoch_timestamp)
-        self._write_timer.set(self._cool_down)
+        if nfo is not None:
+            self._trackers[type_].set_nfo(id_, nfo)
+        self._changed()
+
+    # Checksum of the NFO as of when it and the library were last known to
+    # agree, leaving out the watch state
+    def nfo_checksum(self, type_: str, id_: int) -> Optional[int]:
+        return self._trackers[type_].get(id_, 'nfo_checksum')
+
+    def set_nfo_checksum(self, type_: str, id_: int, checksum: int) -> None:
+        self._trackers[type_].set(id_, 'nfo_checksum', checksum)
+        self._changed()
+
+    def clear_nfo_checksum(self, type_: str, id_: int) -> None:
+        if self.nfo_checksum(type_, id_) is not None:
+            self._trackers[type_].unset(id_, 'nfo_checksum')
+            self._changed()
 
-    def write_changes(self):
+    def write_changes(self) -> None:
         for tracker in self._trackers.values():
             tracker.write()
+        self._write_checkpoint()
+
+        if self._write_timer.is_active:
+            self._write_timer.cancel()
+        self._unwritten = 0
+        self._first_change = None
+        self._last_change = None
+
+    # Called when the write timer goes off. If changes have kept coming in
+    # since it was armed, it waits for them to quiet down, within limits.
+    def write_settled_changes(self) -> None:
+        if self._last_change is None:
+            return
+
+        now = time.monotonic()
+        is_settled = now - self._last_change >= self._quiet_period * 60
+        is_stale = now - self._first_change >= self._max_staleness * 60
+        if is_settled or is_stale:
+            self.write_changes()
+        else:
+            self._write_timer.set(self._quiet_period)
+
+    # Drops records for items that are no longer in the library. This needs a
+    # listing of every item, so it's left to the end of full syncs rather
+    # than being done on every write.
+    def purge(self) -> None:
+        for type_, tracker in self._trackers.items():
+            try:
+                ids = media.get_ids(type_)
+            except jsonrpc.RequestError as error:
+                addon.log(f'Unable to purge removed {type_} items from tracker: {error}')
+                continue
+            tracker.purge(ids)
+        self._changed()
+
+    def _read_checkpoint(self) -> Optional[SyncCheckpoint]:
+        if not xbmcvfs.exists(self._checkpoint_file):
+            return None
+
+        with xbmcvfs.File(self._checkpoint_file) as file:
+            raw_json = file.read()
+
+        try:
+            contents = json.loads(raw_json)
+            return SyncCheckpoint(
+                scan_time=utcdt.fromisoformat(contents['scan_time']),
+                type=contents['type'],
+                position=contents['position']
+            )
+        except (ValueError, KeyError, TypeError):
+            addon.log(f'Unable to read sync checkpoint file "{self._checkpoint_file}", the next sync will start over')
+            return None
+
+    def _write_checkpoint(self) -> None:
+        if not self._is_checkpoint_changed:
+            return
+
+        if self._checkpoint is None:
+            if xbmcvfs.exists(self._checkpoint_file):
+                xbmcvfs.delete(self._checkpoint_file)
+            self._is_checkpoint_changed = False
+            return
+
+        contents = {
+            'scan_time': self._checkpoint.scan_time.isoformat(timespec='seconds'),
+            'type': self._checkpoint.type,
+            'position': self._checkpoint.position
+        }
+
+        xbmcvfs.mkdir(addon.profile)
+        with xbmcvfs.File(self._checkpoint_file, 'w') as file:
+            success = file.write(json.dumps(contents))
+
+        if not success:
+            addon.log(f'Unable to write sync checkpoint file "{self._checkpoint_file}"')
+            addon.notify(32006)
+            return
+
+        self._is_checkpoint_changed = False
+
+    def _changed(self) -> None:
+        now = time.monotonic()
+        self._unwritten += 1
+        self._last_change = now
+        if self._first_change is None:
+            self._first_change = now
+
+        if self._unwritten >= self._max_unwritten or now - self._first_change >= self._max_staleness * 60:
+            self.write_changes()
+        elif not self._write_timer.is_active:
+            self._write_timer.set(self._quiet_period)
 
 
 last_known = _LastKnown()
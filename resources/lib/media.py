@@ -1,15 +1,16 @@
 import os
 import collections
+import json
 import urllib.parse
 import zlib
-from typing import Optional, Final
+from typing import Final, Iterator, Optional
 
 import xbmcvfs
 
 import resources.lib.jsonrpc as jsonrpc
 import resources.lib.settings as settings
 import resources.lib.utcdt as utcdt
-from resources.lib.addon import addon
+from resources.lib.nfo_index import nfo_index
 
 
 def decode_image(path: str) -> str:
@@ -23,21 +24,6 @@ def replace_extension(path: str, extension: str) -> str:
     return os.path.splitext(path)[0] + extension
 
 
-def _find_modification_time(path: str) -> Optional[utcdt.UtcDt]:
-    try:
-        result = jsonrpc.request(
-            'Files.GetFileDetails',
-            file=path,
-            properties=['lastmodified']
-        )
-        local_iso_timestamp = result['filedetails']['lastmodified']
-        return utcdt.fromisoformat(local_iso_timestamp)
-
-    except jsonrpc.RequestError as error:
-        addon.log(str(error), verbose=True)
-        return None
-
-
 def _movie_movie_nfo(path: str) -> str:
     return xbmcvfs.validatePath(os.path.split(path)[0] + '/movie.nfo')
 
@@ -47,17 +33,11 @@ def _movie_filename_nfo(path: str) -> str:
 
 
 def _find_movie_nfo(path: str) -> (Optional[str], Optional[utcdt.UtcDt]):
-    movie = _movie_movie_nfo(path)
-    timestamp = _find_modification_time(movie)
-    if timestamp is not None:
+    movie, timestamp = nfo_index.find(_movie_movie_nfo(path))
+    if movie is not None:
         return movie, timestamp
 
-    filename = _movie_filename_nfo(path)
-    timestamp = _find_modification_time(filename)
-    if timestamp is not None:
-        return filename, timestamp
-
-    return None, None
+    return nfo_index.find(_movie_filename_nfo(path))
 
 
 def _tvshow_nfo(path: str) -> str:
@@ -65,11 +45,7 @@ def _tvshow_nfo(path: str) -> str:
 
 
 def _find_tvshow_nfo(path: str) -> (Optional[str], Optional[utcdt.UtcDt]):
-    nfo = _tvshow_nfo(path)
-    timestamp = _find_modification_time(nfo)
-    if timestamp is not None:
-        return nfo, timestamp
-    return None, None
+    return nfo_index.find(_tvshow_nfo(path))
 
 
 def _episode_nfo(path: str) -> str:
@@ -77,11 +53,7 @@ def _episode_nfo(path: str) -> str:
 
 
 def _find_episode_nfo(path: str) -> (Optional[str], Optional[utcdt.UtcDt]):
-    nfo = _episode_nfo(path)
-    timestamp = _find_modification_time(nfo)
-    if timestamp is not None:
-        return nfo, timestamp
-    return None, None
+    return nfo_index.find(_episode_nfo(path))
 
 
 _TypeInfo = collections.namedtuple('TypeInfo', [
@@ -164,22 +136,130 @@ TYPE_INFO: Final = {
 }
 
 
-def exists(type_: str, id_: int) -> bool:
-    type_info = TYPE_INFO[type_]
-    try:
-        jsonrpc.request(type_info.details_method, **{type_info.id_name: id_, 'properties': []})
-    except jsonrpc.RequestError:
-        return False
-    return True
+_page_size: Final = 500
 
 
-def get_all(type_: str) -> list:
+# What's missing from this gets purged from the trackers, so an item that
+# slips between pages can't be allowed. Each page after the first starts on
+# the last item of the one before, and if that isn't where it's expected to
+# be, something before it was removed and the listing is given up on.
+def get_ids(type_: str) -> set:
     type_info = TYPE_INFO[type_]
-    result = jsonrpc.request(
-        type_info.list_method,
-        properties=['file']
-    )
-    return result[type_info.list_container]
+
+    ids = set()
+    start = 0
+    total = None
+    last_id = None
+    while total is None or start < total:
+        page_start = start if last_id is None else start - 1
+        result = jsonrpc.request(
+            type_info.list_method,
+            properties=[],
+            limits={'start': page_start, 'end': page_start + _page_size}
+        )
+        total = result['limits']['total']
+
+        page = [item[type_info.id_name] for item in result.get(type_info.list_container, [])]
+        if last_id is not None:
+            if not page or page.pop(0) != last_id:
+                raise jsonrpc.RequestError(f'{type_info.list_method} changed while it was being listed')
+        if not page:
+            break
+
+        start += len(page)
+        ids.update(page)
+        last_id = page[-1]
+
+    return ids
+
+
+class PagedItems:
+
+    def __init__(self, type_: str, with_details: bool = True):
+        self._type = type_
+        self._total = None
+        self._first_page = None
+        self._with_details = with_details and settings.performance.bulk_details_limit > 0
+
+    def __len__(self) -> int:
+        if self._total is None:
+            self._first_page = self._request_page(0)
+        return self._total
+
+    def __iter__(self) -> Iterator['MediaInfo']:
+        id_name = TYPE_INFO[self._type].id_name
+
+        start = 0
+        while self._total is None or start < self._total:
+            if start == 0 and self._first_page is not None:
+                page, has_details = self._first_page
+                self._first_page = None
+            else:
+                page, has_details = self._request_page(start)
+
+            if not page:
+                break
+
+            start += len(page)
+            for item in page:
+                file = item.pop('file')
+                details = item if has_details else None
+                yield MediaInfo(self._type, item[id_name], file=file, details=details)
+
+    def _request_page(self, start: int) -> (list, bool):
+        type_info = TYPE_INFO[self._type]
+
+        has_details = self._with_details
+        properties = ['file']
+        if has_details:
+            properties += type_info.details
+
+        # Without a sort, Kodi lists items in the order they were added and
+        # applies the limits in the database query. Sorting would have every
+        # page read and sort the whole table instead. Since new items go on
+        # the end, resuming a sync by position only risks skipping the few
+        # items that shift back when earlier ones are removed, which the
+        # next sync picks up.
+        result = jsonrpc.request(
+            type_info.list_method,
+            properties=properties,
+            limits={'start': start, 'end': start + _page_size}
+        )
+        self._total = result['limits']['total']
+
+        # Past the limit, only the page already in hand keeps its details and
+        # the rest of the items go back to requesting their own
+        if self._total > settings.performance.bulk_details_limit:
+            self._with_details = False
+
+        return result.get(type_info.list_container, []), has_details
+
+
+CHECKSUM_VERSION: Final = 1
+
+# Sorted keys and fixed separators make the JSON, and so the checksum, the
+# same for the same data regardless of key order or Python version. This is
+# done with the C encoder in one pass per section, which is as fast as the
+# repr it replaced; hashing token by token in Python is much slower.
+_canonical_json: Final = json.JSONEncoder(sort_keys=True, separators=(',', ':'), check_circular=False)
+
+# Each section gets its own checksum so an export can tell which parts of an
+# item changed. Details fields not named here, and the movie set, fall under
+# 'other'.
+SECTIONS: Final = ('watched', 'cast', 'art', 'ratings', 'streamdetails', 'uniqueid', 'seasons', 'other')
+
+_field_sections: Final = {
+    'playcount': 'watched',
+    'lastplayed': 'watched',
+    'cast': 'cast',
+    'ratings': 'ratings',
+    'streamdetails': 'streamdetails',
+    'uniqueid': 'uniqueid'
+}
+
+
+def section_of(field: str) -> str:
+    return _field_sections.get(field, 'other')
 
 
 SeasonInfo = collections.namedtuple('SeasonInfo', ['details', 'art'])
@@ -187,18 +267,19 @@ SeasonInfo = collections.namedtuple('SeasonInfo', ['details', 'art'])
 
 class MediaInfo:
 
-    def __init__(self, type_: str, id_: int, file: Optional[str] = None):
+    def __init__(self, type_: str, id_: int, file: Optional[str] = None, details: Optional[dict] = None):
         self.type: Final = type_
         self.id: Final = id_
 
         self._file = file
         self._nfo = ''
 
-        self._details = None
+        self._details = details
         self._art = None
         self._movieset = None
         self._seasons = None
         self._checksum = None
+        self._section_checksums = None
 
     @property
     def file(self) -> str:
@@ -222,54 +303,68 @@ class MediaInfo:
     @property
     def details(self) -> dict:
         if self._details is None:
-            self._details = self._request_details(self.type, self.id)
+            self._fetch()
 
         return self._details
 
     @property
     def art(self) -> dict:
         if self._art is None:
-            self._art = self._request_art(self.type, self.id)
+            self._fetch()
 
         return self._art
 
     @property
     def movieset(self) -> dict:
         if self._movieset is None:
-            if self.type != 'movie' or self.details['setid'] == 0:
-                self._movieset = {}
-            else:
-                self._movieset = self._request_details('movieset', self.details['setid'])
+            self._fetch()
 
         return self._movieset
 
     @property
     def seasons(self) -> dict:
         if self._seasons is None:
-            self._seasons = {}
-            if self.type == 'tvshow':
-                type_info = TYPE_INFO['season']
-                result = jsonrpc.request(
-                    type_info.list_method,
-                    **{'tvshowid': self.id, 'properties': type_info.details}
-                )
-                seasons = result[type_info.list_container]
-                for season in seasons:
-                    art = self._request_art('season', self.id)
-                    self._seasons[season['season']] = SeasonInfo(details=season, art=art)
+            self._fetch()
 
         return self._seasons
 
     @property
     def checksum(self) -> int:
         if self._checksum is None:
-            checksum = zlib.crc32(str(self.details).encode('utf-8'))
-            checksum = zlib.crc32(str(self.art).encode('utf-8'), checksum)
-            checksum = zlib.crc32(str(self.movieset).encode('utf-8'), checksum)
-            self._checksum = zlib.crc32(str(self.seasons).encode('utf-8'), checksum)
+            checksum = 0
+            for section in (self.details, self.art, self.movieset, self.seasons):
+                checksum = zlib.crc32(_canonical_json.encode(section).encode('ascii'), checksum)
+            self._checksum = checksum
 
         return self._checksum
 
+    # Checksums for each of SECTIONS, in the same order
+    @property
+    def section_checksums(self) -> tuple:
+        if self._section_checksums is None:
+            sections = {section: {} for section in SECTIONS}
+            for field, value in self.details.items():
+                sections[section_of(field)][field] = value
+            sections['art'] = self.art
+            sections['seasons'] = self.seasons
+            sections['other']['movieset'] = self.movieset
+            self._section_checksums = tuple(
+                zlib.crc32(_canonical_json.encode(sections[section]).encode('ascii'))
+                for section in SECTIONS
+            )
+
+        return self._section_checksums
+
+    # The checksum as it was calculated before CHECKSUM_VERSION 1, which
+    # depended on dict ordering and Python's repr formatting. Only needed to
+    # recognise unchanged items in trackers written by older versions.
+    @property
+    def legacy_checksum(self) -> int:
+        checksum = zlib.crc32(str(self.details).encode('utf-8'))
+        checksum = zlib.crc32(str(self.art).encode('utf-8'), checksum)
+        checksum = zlib.crc32(str(self.movieset).encode('utf-8'), checksum)
+        return zlib.crc32(str(self.seasons).encode('utf-8'), checksum)
+
     def nfo_modification_time(self) -> Optional[utcdt.UtcDt]:
         if self._nfo is None:
             return None
@@ -277,7 +372,7 @@ class MediaInfo:
             self._nfo, modification_time = TYPE_INFO[self.type].nfo_finder(self.file)
             return modification_time
         else:
-            return _find_modification_time(self._nfo)
+            return nfo_index.modification_time(self._nfo)
 
     def create_nfo_path(self):
         if self.type == 'movie':
@@ -292,18 +387,64 @@ class MediaInfo:
         if self.type == 'tvshow':
             self._nfo = _tvshow_nfo(self._file)
 
-    def _request_art(self, type_: str, id_: int):
+    # Fills in everything that hasn't been requested yet using as few round
+    # trips as possible. The movie set and season art depend on the results
+    # of the first batch, so those need a second one.
+    def _fetch(self) -> None:
+        type_info = TYPE_INFO[self.type]
+
+        calls = {}
+        if self._details is None:
+            calls['details'] = self._details_call(self.type, self.id)
+        if self._art is None:
+            calls['art'] = self._art_call(self.type, self.id)
+        if self._seasons is None and self.type == 'tvshow':
+            season_info = TYPE_INFO['season']
+            calls['seasons'] = jsonrpc.Call(
+                season_info.list_method,
+                {'tvshowid': self.id, 'properties': season_info.details}
+            )
+        results = self._request_batch(calls)
+
+        if 'details' in results:
+            self._details = results['details'][type_info.details_container]
+        if 'art' in results:
+            self._art = results['art']['availableart']
+
+        calls = {}
+        if self._movieset is None and self.type == 'movie' and self._details.get('setid', 0) != 0:
+            calls['movieset'] = self._details_call('movieset', self._details['setid'])
+        seasons = []
+        if 'seasons' in results:
+            seasons = results['seasons'].get(TYPE_INFO['season'].list_container, [])
+            for season in seasons:
+                calls[season['seasonid']] = self._art_call('season', season['seasonid'])
+        results = self._request_batch(calls)
+
+        if self._movieset is None:
+            if 'movieset' in results:
+                self._movieset = results['movieset'][TYPE_INFO['movieset'].details_container]
+            else:
+                self._movieset = {}
+
+        if self._seasons is None:
+            self._seasons = {}
+            for season in seasons:
+                art = results[season['seasonid']]['availableart']
+                self._seasons[season['season']] = SeasonInfo(details=season, art=art)
+
+    def _request_batch(self, calls: dict) -> dict:
+        keys = list(calls.keys())
+        results = jsonrpc.request_batch(list(calls.values()))
+        for result in results:
+            if isinstance(result, jsonrpc.RequestError):
+                raise result
+        return dict(zip(keys, results))
+
+    def _art_call(self, type_: str, id_: int) -> jsonrpc.Call:
         type_info = TYPE_INFO[type_]
-        result = jsonrpc.request(
-            'VideoLibrary.GetAvailableArt',
-            **{'item': {type_info.id_name: id_}}
-        )
-        return result['availableart']
+        return jsonrpc.Call('VideoLibrary.GetAvailableArt', {'item': {type_info.id_name: id_}})
 
-    def _request_details(self, type_: str, id_: int) -> dict:
+    def _details_call(self, type_: str, id_: int) -> jsonrpc.Call:
         type_info = TYPE_INFO[type_]
-        result = jsonrpc.request(
-            type_info.details_method,
-            **{type_info.id_name: id_, 'properties': type_info.details}
-        )
-        return result[type_info.details_container]
+        return jsonrpc.Call(type_info.details_method, {type_info.id_name: id_, 'properties': type_info.details})
@@ -0,0 +1,122 @@
+import xml.etree.ElementTree as ElementTree
+import zlib
+from typing import Final, Iterable, Optional
+
+
+WATCH_STATE_TAGS: Final = ('playcount', 'lastplayed', 'watched', 'userrating')
+
+
+# Checksum of an NFO's contents that doesn't change with formatting, so a
+# reformatted NFO still matches. Comments and any top level tags given to
+# ignore are left out.
+def content_checksum(root: ElementTree.Element, ignored_tags: Iterable = ()) -> int:
+    ignored_tags = set(ignored_tags)
+    checksum = zlib.crc32(root.tag.encode('utf-8'))
+    for child in root:
+        if not isinstance(child.tag, str) or child.tag in ignored_tags:
+            continue
+        parts = []
+        for element in child.iter():
+            if not isinstance(element.tag, str):
+                continue
+            attributes = ''.join(f' {name}={value}' for name, value in sorted(element.attrib.items()))
+            parts.append(f'<{element.tag}{attributes}|{len(element)}>{(element.text or "").strip()}')
+        checksum = zlib.crc32('\n'.join(parts).encode('utf-8'), checksum)
+    return checksum
+
+
+# Wraps the root of an NFO with indexes of its top level elements by tag and
+# of its art by type and season, so that finding what to replace doesn't
+# mean scanning the whole document for every field. Anything that changes
+# the top level has to go through here to keep the indexes right; elements
+# further down can be changed directly.
+class NfoDocument:
+
+    def __init__(self, root: ElementTree.Element):
+        self.root: Final = root
+        self._elements = {}
+        self._thumbs = {}
+        self._actors = None
+
+        for element in root:
+            self._index(element)
+
+    def find(self, tag: str) -> Optional[ElementTree.Element]:
+        elements = self._elements.get(tag)
+        if not elements:
+            return None
+        return elements[0]
+
+    def find_all(self, tag: str, **attributes: str) -> list:
+        elements = self._elements.get(tag, [])
+        if attributes:
+            return [
+                element for element in elements
+                if all(element.get(name) == value for name, value in attributes.items())
+            ]
+        return list(elements)
+
+    # Thumbs without a season are only those that have no season set at all
+    def thumbs(self, aspect: str, season: Optional[int] = None) -> list:
+        return list(self._thumbs.get(self._thumb_key(aspect, season), []))
+
+    # Actors are looked up by their name as it was when first asked for,
+    # with the first actor of a name winning as it would for find
+    def actor(self, name: str) -> Optional[ElementTree.Element]:
+        if self._actors is None:
+            self._actors = {}
+            for element in self._elements.get('actor', []):
+                actor_name = element.findtext('name')
+                if actor_name is not None:
+                    self._actors.setdefault(actor_name, element)
+
+        return self._actors.get(name)
+
+    def add(self, tag: str, text: Optional[str] = None, attributes: Optional[dict] = None) -> ElementTree.Element:
+        element = ElementTree.SubElement(self.root, tag, attributes or {})
+        if text is not None:
+            element.text = text
+        self._index(element)
+        return element
+
+    def append(self, element: ElementTree.Element) -> None:
+        self.root.append(element)
+        self._index(element)
+
+    def set(self, tag: str, text: Optional[str] = None) -> ElementTree.Element:
+        self.remove(self.find_all(tag))
+        return self.add(tag, text)
+
+    # Removing everything in one pass keeps clearing out a large number of
+    # elements linear, where removing them one by one wouldn't be
+    def remove(self, elements: list) -> None:
+        if not elements:
+            return
+
+        removed = {id(element) for element in elements}
+        self.root[:] = [element for element in self.root if id(element) not in removed]
+
+        tags = {element.tag for element in elements}
+        for tag in tags:
+            self._elements[tag] = [element for element in self._elements[tag] if id(element) not in removed]
+            if tag == 'actor':
+                self._actors = None
+
+        thumb_keys = {self._thumb_key(element.get('aspect'), element.get('season')) for element in elements
+                      if element.tag == 'thumb'}
+        for key in thumb_keys:
+            self._thumbs[key] = [element for element in self._thumbs[key] if id(element) not in removed]
+
+    def _index(self, element: ElementTree.Element) -> None:
+        self._elements.setdefault(element.tag, []).append(element)
+        if element.tag == 'thumb':
+            key = self._thumb_key(element.get('aspect'), element.get('season'))
+            self._thumbs.setdefault(key, []).append(element)
+        elif element.tag == 'actor':
+            self._actors = None
+
+    @staticmethod
+    def _thumb_key(aspect: Optional[str], season) -> tuple:
+        if season is None or season == '':
+            return aspect, None
+        return aspect, str(season)
@@ -0,0 +1,200 @@
+import collections
+import json
+import os
+import time
+from typing import Final, Optional
+
+import xbmcvfs
+
+import resources.lib.jsonrpc as jsonrpc
+import resources.lib.settings as settings
+import resources.lib.utcdt as utcdt
+from resources.lib.addon import addon
+
+
+_Listing = collections.namedtuple('Listing', ['mtime', 'nfos'])
+_Nfo = collections.namedtuple('Nfo', ['name', 'lastmodified', 'size'])
+
+
+class _NfoIndex:
+
+    _max_untrusted_directories: Final = 64
+    _lifetime: Final = 60  # Seconds
+    _settle_time: Final = 2  # Seconds
+
+    _version: Final = 1
+
+    def __init__(self):
+        self._file: Final = xbmcvfs.translatePath(f'{addon.profile}nfo_index.json')
+        self._listings = {}
+        self._checked = {}
+        self._untrusted = collections.OrderedDict()
+        self._seen = set()
+        self._is_loaded = False
+        self._has_unwritten_changes = False
+
+    # Names are matched ignoring case, the way SMB and Windows shares match
+    # them, so NFOs are found however they're cased. The path returned is
+    # the one actually listed, since local and NFS paths are case sensitive
+    # when the file is opened.
+    def find(self, path: str) -> (Optional[str], Optional[utcdt.UtcDt]):
+        directory, name = os.path.split(path)
+        nfo = self._nfos(directory).get(name.casefold())
+        if nfo is None:
+            return None, None
+        return path[:len(path) - len(name)] + nfo.name, utcdt.fromisoformat(nfo.lastmodified)
+
+    def modification_time(self, path: str) -> Optional[utcdt.UtcDt]:
+        _, modification_time = self.find(path)
+        return modification_time
+
+    def invalidate(self, path: str) -> None:
+        directory, _ = os.path.split(path)
+        self._checked.pop(directory, None)
+        self._untrusted.pop(directory, None)
+        if self._listings.pop(directory, None) is not None:
+            self._has_unwritten_changes = True
+
+    # Forgets every directory that hasn't been looked at since the last prune,
+    # so folders for media that has left the library don't pile up forever.
+    def prune(self) -> None:
+        for directory in self._listings.keys() - self._seen:
+            del self._listings[directory]
+            self._checked.pop(directory, None)
+            self._untrusted.pop(directory, None)
+            self._has_unwritten_changes = True
+        self._seen.clear()
+
+    def write(self) -> None:
+        if not self._has_unwritten_changes:
+            return
+
+        directories = {}
+        for directory, listing in self._listings.items():
+            if listing.mtime is None:
+                continue
+            directories[directory] = {
+                'mtime': listing.mtime,
+                'nfos': {nfo.name: [nfo.lastmodified, nfo.size] for nfo in listing.nfos.values()}
+            }
+        contents = {
+            'version': self._version,
+            'directories': directories
+        }
+
+        xbmcvfs.mkdir(addon.profile)
+        with xbmcvfs.File(self._file, 'w') as file:
+            success = file.write(json.dumps(contents))
+
+        if not success:
+            addon.log(f'Unable to write NFO index file "{self._file}"')
+            addon.notify(32006)
+            return
+
+        self._has_unwritten_changes = False
+
+    def _nfos(self, directory: str) -> dict:
+        self._seen.add(directory)
+
+        checked = self._checked.get(directory)
+        if checked is not None and time.monotonic() - checked < self._lifetime:
+            if directory in self._untrusted:
+                self._untrusted.move_to_end(directory)
+            return self._listings[directory].nfos
+
+        mtime = None
+        if settings.performance.should_trust_folder_times:
+            self._load()
+            mtime = self._directory_mtime(directory)
+            listing = self._listings.get(directory)
+            if listing is not None and mtime is not None and listing.mtime == mtime:
+                self._mark_checked(directory)
+                return listing.nfos
+
+        listing = _Listing(mtime=mtime, nfos=self._list(directory))
+        self._listings[directory] = listing
+        self._mark_checked(directory)
+        if mtime is not None:
+            self._has_unwritten_changes = True
+
+        return listing.nfos
+
+    def _mark_checked(self, directory: str) -> None:
+        self._checked[directory] = time.monotonic()
+
+        # Untrusted listings are only good for their lifetime, so there's no
+        # point holding on to more than the directories currently being worked
+        if self._listings[directory].mtime is not None:
+            self._untrusted.pop(directory, None)
+            return
+        self._untrusted[directory] = None
+        self._untrusted.move_to_end(directory)
+        while len(self._untrusted) > self._max_untrusted_directories:
+            expired, _ = self._untrusted.popitem(last=False)
+            del self._listings[expired]
+            del self._checked[expired]
+
+    def _directory_mtime(self, directory: str) -> Optional[int]:
+        mtime = xbmcvfs.Stat(directory).st_mtime()
+
+        # Folder times only have a resolution of a second or two, so a
+        # listing taken right after a change could miss a second change
+        # made within the same tick. Those aren't trusted until they settle.
+        if not mtime or time.time() - mtime < self._settle_time:
+            return None
+
+        return mtime
+
+    def _list(self, directory: str) -> dict:
+        separator = '\\' if '\\' in directory and '/' not in directory else '/'
+
+        try:
+            result = jsonrpc.request(
+                'Files.GetDirectory',
+                directory=directory + separator,
+                media='files',
+                properties=['lastmodified', 'size']
+            )
+        except jsonrpc.RequestError as error:
+            addon.log(str(error), verbose=True)
+            return {}
+
+        nfos = {}
+        for item in result.get('files') or []:
+            if item.get('filetype') != 'file':
+                continue
+            name = os.path.basename(item['file'])
+            if os.path.splitext(name)[1].lower() != '.nfo':
+                continue
+            nfos[name.casefold()] = _Nfo(name=name, lastmodified=item['lastmodified'], size=item.get('size', 0))
+
+        return nfos
+
+    def _load(self) -> None:
+        if self._is_loaded:
+            return
+        self._is_loaded = True
+
+        if not xbmcvfs.exists(self._file):
+            return
+
+        with xbmcvfs.File(self._file) as file:
+            raw_json = file.read()
+
+        try:
+            contents = json.loads(raw_json)
+        except ValueError:
+            addon.log(f'Unable to read NFO index file "{self._file}", it will be rebuilt')
+            return
+
+        if contents.get('version') != self._version:
+            return
+
+        for directory, listing in contents.get('directories', {}).items():
+            if directory in self._listings:
+                continue
+            nfos = {name.casefold(): _Nfo(name, *nfo) for name, nfo in listing['nfos'].items()}
+            self._listings[directory] = _Listing(mtime=listing['mtime'], nfos=nfos)
+
+
+nfo_index: Final = _NfoIndex()
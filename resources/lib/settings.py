@@ -9,6 +9,11 @@ class MovieNfoOption(enum.Enum):
     FILENAME = 'filename'
 
 
+class TrackerStorageOption(enum.Enum):
+    FILES = 'files'
+    DATABASE = 'database'
+
+
 class ActorOption(enum.Enum):
     LEAVE = 'leave'
     UPDATE = 'update_by_name'
@@ -69,6 +74,17 @@ class _Export:
     def should_export_plugin_trailers(self) -> bool:
         return addon.getSettingBool('export.should_export_plugin_trailers')
 
+    @property
+    def should_skip_unchanged(self) -> bool:
+        return addon.getSettingBool('export.should_skip_unchanged')
+
+
+class _Import:
+
+    @property
+    def should_set_watch_state(self) -> bool:
+        return addon.getSettingBool('import.should_set_watch_state')
+
 
 class _Triggers:
 
@@ -146,10 +162,43 @@ class _UI:
         return addon.getSettingBool('ui.is_logging_verbose')
 
 
+class _Performance:
+
+    @property
+    def bulk_details_limit(self) -> int:
+        return addon.getSettingInt('performance.bulk_details_limit')
+
+    @property
+    def tracker_storage(self) -> TrackerStorageOption:
+        return TrackerStorageOption(addon.getSettingString('performance.tracker_storage'))
+
+    @property
+    def should_trust_folder_times(self) -> bool:
+        return addon.getSettingBool('performance.should_trust_folder_times')
+
+    @property
+    def export_threads(self) -> int:
+        return addon.getSettingInt('performance.export_threads')
+
+    @property
+    def import_window(self) -> int:
+        return addon.getSettingInt('performance.import_window')
+
+    @property
+    def full_sync_interval(self) -> int:
+        return addon.getSettingInt('performance.full_sync_interval')
+
+    @property
+    def concurrent_actions(self) -> int:
+        return addon.getSettingInt('performance.concurrent_actions')
+
+
 sync = _Sync()
 export = _Export()
+import_ = _Import()
 triggers = _Triggers()
 avoidance = _Avoidance()
 periodic = _Periodic()
 scheduled = _Scheduled()
 ui = _UI()
+performance = _Performance()
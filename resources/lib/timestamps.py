@@ -25,6 +25,12 @@ class _Timestamps:
         else:
             self._last_sync = utcdt.fromisoformat(last_sync)
 
+        last_full_sync = contents.get('last_full_sync')
+        if last_full_sync is None:
+            self._last_full_sync = utcdt.fromtimestamp(0)
+        else:
+            self._last_full_sync = utcdt.fromisoformat(last_full_sync)
+
         next_scheduled = contents.get('next_scheduled')
         if next_scheduled is None:
             self._next_scheduled = datetime.datetime(year=1980, month=1, day=1)
@@ -42,6 +48,15 @@ class _Timestamps:
         self._last_sync = timestamp
         self._write()
 
+    @property
+    def last_full_sync(self) -> utcdt.UtcDt:
+        return self._last_full_sync
+
+    @last_full_sync.setter
+    def last_full_sync(self, timestamp: utcdt.UtcDt) -> None:
+        self._last_full_sync = timestamp
+        self._write()
+
     @property
     def next_scheduled(self) -> datetime.datetime:
         return self._next_scheduled
@@ -54,6 +69,7 @@ class _Timestamps:
     def _write(self):
         contents = {
             'last_sync': self._last_sync.isoformat(timespec='seconds'),
+            'last_full_sync': self._last_full_sync.isoformat(timespec='seconds'),
             'next_scheduled': self._next_scheduled.isoformat(timespec='seconds')
         }
 
@@ -11,15 +11,17 @@ import resources.lib.jsonrpc as jsonrpc
 import resources.lib.media as media
 import resources.lib.settings as settings
 import resources.lib.utcdt as utcdt
+from resources.lib.action_queue import ActionQueue
 from resources.lib.addon import addon, player
 from resources.lib.alarm import Alarm
 from resources.lib.last_known import last_known
+from resources.lib.nfo_index import nfo_index
 from resources.lib.timestamps import timestamps
 
 
 class Service(xbmc.Monitor):
 
-    _limited_actions: Final = ['Sync All', 'Import All', 'Export All']
+    _update_settle_seconds: Final = 5
 
     def __init__(self):
         super().__init__()
@@ -27,9 +29,9 @@ class Service(xbmc.Monitor):
         addon.set_logging(verbose=settings.ui.is_logging_verbose)
         addon.set_notifications(notify=settings.ui.should_show_notifications)
 
-        self._active_action = None
-        self._action_queue = collections.deque()
-        self._patient_action_queue = collections.deque()
+        self._active_actions = []
+        self._action_queue = ActionQueue()
+        self._pending_updates = collections.OrderedDict()
 
         self._periodic_trigger = Alarm(
             name='Service.PeriodicTrigger',
@@ -41,11 +43,17 @@ class Service(xbmc.Monitor):
             name='Service.AvoidanceWait',
             message=jsonrpc.INTERNAL_METHODS.wait_done.send
         )
+        self._update_settler = Alarm(
+            name='Service.UpdateSettle',
+            message=jsonrpc.INTERNAL_METHODS.updates_settled.send
+        )
 
         if settings.triggers.should_sync_on_start:
             self._queue_action(actions.SyncAll(), patient=False)
         elif self._is_scheduled_sync_due() and settings.scheduled.should_run_missed_syncs:
             self._queue_action(actions.SyncAll(), patient=False)
+        elif last_known.checkpoint is not None:
+            self._queue_action(actions.SyncAll(), patient=True)
 
         if settings.scheduled.is_enabled:
             self._update_schedule()
@@ -59,12 +67,15 @@ class Service(xbmc.Monitor):
                 self._update_schedule()
 
         last_known.write_changes()
+        nfo_index.write()
 
     def onNotification(self, sender: str, method: str, data: str) -> None:
         data = json.loads(data)
 
-        if self._active_action and method == self._active_action.awaiting:
-            is_notification_consumed = self._continue_actions(data)
+        # Each notification goes to the actions waiting on it in the order they
+        # started, until one of them consumes it
+        for action in [action for action in self._active_actions if action.is_awaiting(method)]:
+            is_notification_consumed = self._continue_action(action, method, data)
             if is_notification_consumed:
                 return
 
@@ -82,6 +93,8 @@ class Service(xbmc.Monitor):
             self._queue_action(actions.ExportAll(), patient=data['patient'])
         elif method == jsonrpc.INTERNAL_METHODS.wait_done.recv:
             self._run_actions()
+        elif method == jsonrpc.INTERNAL_METHODS.updates_settled.recv:
+            self._export_updates()
         elif method == jsonrpc.INTERNAL_METHODS.write_changes.recv:
             self._queue_action(actions.WriteChanges(), patient=data['patient'])
         elif method == 'Player.OnPlay':
@@ -90,6 +103,8 @@ class Service(xbmc.Monitor):
             self._play_stop()
         elif method == 'VideoLibrary.OnUpdate':
             self._library_update(data)
+        elif method == 'VideoLibrary.OnRemove':
+            self._library_remove(data)
         elif method == 'VideoLibrary.OnScanFinished' and settings.triggers.should_sync_on_scan:
             self._queue_action(actions.SyncAll(should_skip_scan=True), patient=True)
 
@@ -142,6 +157,8 @@ class Service(xbmc.Monitor):
         if item['type'] not in ['movie', 'tvshow', 'episode']:
             return
 
+        last_known.mark_dirty(item['type'], item['id'])
+
         if not settings.triggers.should_export_on_update:
             if data.get('added'):
                 last_known.set_timestamp(item['type'], item['id'], utcdt.now())
@@ -154,8 +171,31 @@ class Service(xbmc.Monitor):
             last_known.set_checksum(item['type'], item['id'])
             return
 
-        info = media.MediaInfo(item['type'], item['id'])
-        self._queue_action(actions.ExportOne(info), patient=False)
+        # Scraping, refreshing and marking things watched each send several
+        # updates per item in quick succession, so updates are gathered up
+        # and each item is exported once things have settled
+        self._pending_updates[(item['type'], item['id'])] = None
+        if not self._update_settler.is_active:
+            self._update_settler.set_seconds(self._update_settle_seconds)
+
+    # Items that already have an export or sync waiting to run will pick
+    # up the changes then
+    def _export_updates(self) -> None:
+        while self._pending_updates:
+            item, _ = self._pending_updates.popitem(last=False)
+            if (self._action_queue.is_queued('Export One', item, patient=False)
+                    or self._action_queue.is_queued('Sync One', item, patient=False)):
+                continue
+            info = media.MediaInfo(*item)
+            self._queue_action(actions.ExportOne(info, only_changed=True), patient=False)
+
+    # Refreshes also remove items, which come back under the same ID, so
+    # the records of removed items are left for the next full sync to purge
+    def _library_remove(self, data: dict) -> None:
+        if data.get('type') not in ['movie', 'tvshow', 'episode']:
+            return
+
+        self._pending_updates.pop((data['type'], data['id']), None)
 
     def _play_stop(self):
         if settings.avoidance.wait_time:
@@ -163,65 +203,69 @@ class Service(xbmc.Monitor):
         else:
             self._run_actions()
 
-    @property
-    def _queued_types(self) -> set:
-        types = set()
-        if self._active_action:
-            types.add(self._active_action.type)
-        for action in self._action_queue:
-            types.add(action.type)
-        for action in self._patient_action_queue:
-            types.add(action.type)
-        return types
-
     @property
     def _can_patient_actions_run(self) -> bool:
         if (settings.avoidance.is_enabled and player.isPlaying()) or self._waiter.is_active:
             return False
         return True
 
-    def _run_action(self, action: actions.Action, data: Optional[dict] = None) -> bool:
+    # Starts an action, or continues it with a notification if one is given
+    def _run_action(self, action: actions.Action, method: Optional[str] = None, data: Optional[dict] = None) -> bool:
         try:
-            return action.run(data)
+            if method is None:
+                return action.run()
+            return action.receive(method, data)
         except actions.ActionError as error:
             addon.log(''.join(traceback.TracebackException.from_exception(error).format()))
             addon.notify(error.notification)
 
-    def _run_actions(self) -> None:
-        if self._active_action:
-            return
+    # Actions that are waiting on Kodi leave room for others to start, so
+    # long as they're single item actions on different items and there's
+    # room for another of the same type. The All actions run on their own.
+    def _can_start(self, action: actions.Action) -> bool:
+        if not self._active_actions:
+            return True
 
-        while self._action_queue:
-            self._active_action = self._action_queue.pop()
-            self._run_action(self._active_action)
-            if not self._active_action.is_done:
-                return
+        limit = settings.performance.concurrent_actions
+        if limit <= 1 or self._action_queue.is_limited(action):
+            return False
 
-        while self._patient_action_queue and self._can_patient_actions_run:
-            self._active_action = self._patient_action_queue.pop()
-            self._run_action(self._active_action)
-            if not self._active_action.is_done:
-                return
+        same_type_count = 0
+        for active_action in self._active_actions:
+            if self._action_queue.is_limited(active_action):
+                return False
+            if action.item is not None and active_action.item == action.item:
+                return False
+            if active_action.type == action.type:
+                same_type_count += 1
 
-        self._active_action = None
+        return same_type_count < limit
 
-    def _continue_actions(self, data: dict) -> bool:
-        is_notification_consumed = self._run_action(self._active_action, data)
-        if self._active_action.is_done:
-            self._active_action = None
+    def _run_actions(self) -> None:
+        while True:
+            action = self._action_queue.pop(can_run_patient=self._can_patient_actions_run, can_start=self._can_start)
+            if action is None:
+                return
+            self._run_action(action)
+            if not action.is_done:
+                self._active_actions.append(action)
+
+    def _continue_action(self, action: actions.Action, method: str, data: dict) -> bool:
+        is_notification_consumed = self._run_action(action, method, data)
+        if action.is_done:
+            self._active_actions.remove(action)
             self._run_actions()
         return is_notification_consumed
 
     def _queue_action(self, action: actions.Action, patient: bool):
-        if action.type in self._limited_actions and action.type in self._queued_types:
+        # Only one of each of the limited actions at a time, including one
+        # that's already running
+        if (self._action_queue.is_limited(action)
+                and any(active_action.type == action.type for active_action in self._active_actions)):
             return
 
-        if patient:
-            self._patient_action_queue.append(action)
-        else:
-            self._action_queue.append(action)
-
-        self._run_actions()
+        if self._action_queue.push(action, patient):
+            self._run_actions()
 
 
 if __name__ == "__main__":